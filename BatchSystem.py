@@ -0,0 +1,348 @@
+# batch system backends used by submit_MG_jobs.py: submit, status, cancel and resubmit of job scripts.
+# Submitted jobs are recorded in a registry (JSON lines, the last entry of a script counts), so that the status
+# of all jobs of a scan can be queried and only finished jobs are resubmitted.
+# The local backend is a stand-in scheduler: jobs are files in a queue directory, run by N workers
+# (python BatchSystem.py -q local_queue -n 8), e.g. to test and benchmark the whole workflow on one machine.
+
+import sys, os
+import json
+import time
+import random
+import signal
+import socket
+import subprocess as sp
+import multiprocessing
+from abc import ABCMeta, abstractmethod
+from optparse import OptionParser
+
+job_states = ['pending', 'running', 'done', 'failed', 'cancelled', 'unknown']
+
+# output of a batch system command, empty if it fails
+def run_command(command, input = None):
+    try:
+        process = sp.Popen(command, stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
+    except OSError as e:
+        print 'Error: could not run %s: %s' % (command[0], e)
+        return ''
+    output, error = process.communicate(input)
+    if process.returncode != 0:
+        print 'Warning: %s failed: %s' % (' '.join(command), error.strip())
+    return output
+
+# splits long lists of job ids, to keep the command lines short
+def chunks(values, size = 500):
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
+# base of the backends: a backend missing one of the abstract methods can not be instantiated
+class BatchSystem(object) :
+    __metaclass__ = ABCMeta
+    name = ''
+
+    def __init__(self, jobs_filename = 'submitted_jobs.jsonl'):
+        self.jobs_filename = jobs_filename
+        self.jobs = {}
+        if os.path.isfile(jobs_filename):
+            for line in open(jobs_filename, 'r'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.jobs[record['script']] = record
+        self.states = None
+
+    # backend specific: submit a script with a run time request in minutes, return the job id (None on failure)
+    @abstractmethod
+    def submit_script(self, script, minutes):
+        pass
+
+    # backend specific: states (one of job_states) by job id, jobs unknown to the batch system can be left out
+    @abstractmethod
+    def job_states(self, job_ids):
+        pass
+
+    # backend specific
+    @abstractmethod
+    def cancel_job(self, job_id):
+        pass
+
+    def submit(self, script, minutes = 8):
+        script = os.path.abspath(script)
+        job_id = self.submit_script(script, minutes)
+        if job_id is None:
+            print 'Error: submission of %s failed' % script
+            return None
+        record = {'script' : script, 'backend' : self.name, 'job_id' : job_id, 'minutes' : minutes, 'submitted' : time.time()}
+        self.jobs[script] = record
+        jobs_file = open(self.jobs_filename, 'a')
+        jobs_file.write(json.dumps(record, sort_keys = True) + '\n')
+        jobs_file.close()
+        if self.states is not None:
+            self.states[script] = 'pending'
+        return job_id
+
+    # state by script of the jobs submitted with this backend (all of them if no scripts are given),
+    # queried once and cached, refresh to query again
+    def status(self, scripts = None, refresh = False):
+        if self.states is None or refresh:
+            own_jobs = [record for record in self.jobs.values() if record['backend'] == self.name]
+            states_by_id = {}
+            for job_ids in chunks([record['job_id'] for record in own_jobs]):
+                states_by_id.update(self.job_states(job_ids))
+            self.states = dict((record['script'], states_by_id.get(record['job_id'], 'unknown')) for record in own_jobs)
+        if scripts is None:
+            return dict(self.states)
+        return dict((os.path.abspath(script), self.states.get(os.path.abspath(script), 'unknown')) for script in scripts)
+
+    def is_active(self, script):
+        return self.status([script]).values()[0] in ['pending', 'running']
+
+    def cancel(self, scripts = None):
+        if scripts is None:
+            scripts = [script for script, state in self.status().items() if state in ['pending', 'running']]
+        for script in scripts:
+            record = self.jobs.get(os.path.abspath(script))
+            if record is None or record['backend'] != self.name:
+                continue
+            self.cancel_job(record['job_id'])
+            if self.states is not None:
+                self.states[record['script']] = 'cancelled'
+        return len(scripts)
+
+    # submits the script again unless it is still pending or running, returns the job id or None
+    def resubmit(self, script, minutes = 60):
+        if self.is_active(script):
+            return None
+        return self.submit(script, minutes)
+
+class LSF(BatchSystem) :
+    name = 'lsf'
+    # queues and their (normalised) time limits in minutes
+    queues = [('8nm', 8), ('1nh', 60), ('8nh', 480), ('1nd', 1440), ('2nd', 2880), ('1nw', 10080)]
+    state_names = {'PEND' : 'pending', 'PSUSP' : 'pending', 'RUN' : 'running', 'USUSP' : 'running', 'SSUSP' : 'running',
+                   'DONE' : 'done', 'EXIT' : 'failed'}
+
+    # shortest queue with a time limit comfortably above the requested time
+    def queue(self, minutes, safety_factor = 1.5):
+        for queue, limit in self.queues:
+            if minutes * safety_factor <= limit:
+                return queue
+        return self.queues[-1][0]
+
+    def submit_script(self, script, minutes):
+        # Job <123456> is submitted to queue <8nm>.
+        output = run_command(['bsub', '-q', self.queue(minutes), script])
+        if not '<' in output:
+            return None
+        return output.split('<')[1].split('>')[0]
+
+    def job_states(self, job_ids):
+        states = {}
+        for line in run_command(['bjobs', '-a', '-w'] + job_ids).splitlines()[1:]:
+            columns = line.split()
+            if len(columns) > 2:
+                states[columns[0]] = self.state_names.get(columns[2], 'unknown')
+        return states
+
+    def cancel_job(self, job_id):
+        run_command(['bkill', job_id])
+
+class HTCondor(BatchSystem) :
+    name = 'condor'
+    # job flavours and their time limits in minutes
+    flavours = [('espresso', 20), ('microcentury', 60), ('longlunch', 120), ('workday', 480), ('tomorrow', 1440),
+                ('testmatch', 4320), ('nextweek', 10080)]
+    # JobStatus codes
+    state_names = {'1' : 'pending', '2' : 'running', '3' : 'cancelled', '4' : 'done', '5' : 'pending', '6' : 'failed', '7' : 'pending'}
+
+    def flavour(self, minutes, safety_factor = 1.5):
+        for flavour, limit in self.flavours:
+            if minutes * safety_factor <= limit:
+                return flavour
+        return self.flavours[-1][0]
+
+    def submit_script(self, script, minutes):
+        name = os.path.splitext(script)[0]
+        description = '\n'.join(['executable = ' + script,
+                                 'output = ' + name + '.condor.out',
+                                 'error = ' + name + '.condor.err',
+                                 'log = ' + name + '.condor.log',
+                                 '+JobFlavour = "%s"' % self.flavour(minutes),
+                                 'queue', ''])
+        # 1 job(s) submitted to cluster 123456.
+        output = run_command(['condor_submit', '-'], description)
+        if not 'cluster' in output:
+            return None
+        return output.split('cluster')[1].strip().rstrip('.')
+
+    def job_states(self, job_ids):
+        states = {}
+        for line in run_command(['condor_q'] + job_ids + ['-af', 'ClusterId', 'JobStatus']).splitlines():
+            columns = line.split()
+            if len(columns) == 2:
+                states[columns[0]] = self.state_names.get(columns[1], 'unknown')
+        # finished jobs are only in the history
+        finished_ids = [job_id for job_id in job_ids if not job_id in states]
+        if finished_ids:
+            for line in run_command(['condor_history'] + finished_ids + ['-af', 'ClusterId', 'JobStatus', 'ExitCode']).splitlines():
+                columns = line.split()
+                if len(columns) == 3:
+                    state = self.state_names.get(columns[1], 'unknown')
+                    if state == 'done' and columns[2] != '0':
+                        state = 'failed'
+                    states[columns[0]] = state
+        return states
+
+    def cancel_job(self, job_id):
+        run_command(['condor_rm', job_id])
+
+class Slurm(BatchSystem) :
+    name = 'slurm'
+    state_names = {'PENDING' : 'pending', 'REQUEUED' : 'pending', 'RUNNING' : 'running', 'COMPLETING' : 'running',
+                   'COMPLETED' : 'done', 'FAILED' : 'failed', 'TIMEOUT' : 'failed', 'NODE_FAIL' : 'failed',
+                   'OUT_OF_MEMORY' : 'failed', 'CANCELLED' : 'cancelled'}
+
+    def submit_script(self, script, minutes):
+        name = os.path.splitext(script)[0]
+        output = run_command(['sbatch', '--parsable', '--time=%d' % max(1, int(minutes * 1.5 + 0.5)), '--output=' + name + '.slurm.out', script])
+        if not output.strip():
+            return None
+        return output.strip().split(';')[0]
+
+    def job_states(self, job_ids):
+        states = {}
+        for line in run_command(['sacct', '-n', '-X', '-P', '-o', 'JobID,State', '-j', ','.join(job_ids)]).splitlines():
+            columns = line.split('|')
+            if len(columns) == 2:
+                # e.g. "CANCELLED by 1234"
+                states[columns[0]] = self.state_names.get(columns[1].split()[0], 'unknown')
+        return states
+
+    def cancel_job(self, job_id):
+        run_command(['scancel', job_id])
+
+# stand-in scheduler: one file per job in the directory of its state, moved between the directories with (atomic) renames
+class LocalScheduler(BatchSystem) :
+    name = 'local'
+
+    def __init__(self, jobs_filename = 'submitted_jobs.jsonl', queue_path = 'local_queue'):
+        BatchSystem.__init__(self, jobs_filename)
+        self.queue_path = os.path.abspath(queue_path)
+        for state in job_states[:-1] + ['logs']:
+            if not os.path.isdir(self.queue_path + '/' + state):
+                os.makedirs(self.queue_path + '/' + state)
+
+    def job_filename(self, state, job_id):
+        return self.queue_path + '/' + state + '/' + job_id
+
+    def submit_script(self, script, minutes):
+        job_id = '%.0f%04d' % (time.time()*1000, random.randint(0, 9999))
+        job = {'script' : script, 'minutes' : minutes, 'submitted' : time.time()}
+        # written under a temporary name, so that workers never pick up a half-written job
+        temporary_filename = self.job_filename('pending', '.' + job_id)
+        job_file = open(temporary_filename, 'w')
+        job_file.write(json.dumps(job))
+        job_file.close()
+        os.rename(temporary_filename, self.job_filename('pending', job_id))
+        return job_id
+
+    def job_states(self, job_ids):
+        states = {}
+        for state in job_states[:-1]:
+            for job_id in os.listdir(self.queue_path + '/' + state):
+                states[job_id] = state
+        return dict((job_id, states[job_id]) for job_id in job_ids if job_id in states)
+
+    def cancel_job(self, job_id):
+        try:
+            os.rename(self.job_filename('pending', job_id), self.job_filename('cancelled', job_id))
+            return
+        except OSError:
+            pass
+        # running: the worker moves the job to cancelled once it is killed
+        running_filename = self.job_filename('running', job_id)
+        if os.path.isfile(running_filename):
+            open(running_filename + '.cancel', 'w').close()
+            job = json.load(open(running_filename, 'r'))
+            if 'pid' in job:
+                try:
+                    os.killpg(job['pid'], signal.SIGTERM)
+                except OSError:
+                    pass
+
+# worker of the local scheduler: claims pending jobs (oldest first) and runs them until the queue is empty
+# (exit_when_idle) or forever
+def run_local_worker(queue_path, poll_interval = 1., exit_when_idle = False):
+    scheduler = LocalScheduler(os.devnull, queue_path)
+    while True:
+        pending_jobs = sorted(job_id for job_id in os.listdir(queue_path + '/pending') if not job_id.startswith('.'))
+        if not pending_jobs:
+            if exit_when_idle:
+                return
+            time.sleep(poll_interval)
+            continue
+        job_id = pending_jobs[0]
+        running_filename = scheduler.job_filename('running', job_id)
+        try:
+            os.rename(scheduler.job_filename('pending', job_id), running_filename)
+        except OSError:
+            # another worker has been faster
+            continue
+        job = json.load(open(running_filename, 'r'))
+        log_file = open(queue_path + '/logs/' + job_id + '.out', 'w')
+        start_time = time.time()
+        # own process group, so that cancelling kills the whole job
+        process = sp.Popen(['bash', job['script']], cwd = queue_path, stdout = log_file, stderr = sp.STDOUT, preexec_fn = os.setsid)
+        job.update({'pid' : process.pid, 'host' : socket.gethostname(), 'start_time' : start_time})
+        job_file = open(running_filename, 'w')
+        job_file.write(json.dumps(job))
+        job_file.close()
+        return_code = process.wait()
+        log_file.close()
+        job.update({'return_code' : return_code, 'runtime' : time.time() - start_time})
+        state = 'done'
+        if os.path.isfile(running_filename + '.cancel'):
+            os.remove(running_filename + '.cancel')
+            state = 'cancelled'
+        elif return_code != 0:
+            state = 'failed'
+        job_file = open(running_filename, 'w')
+        job_file.write(json.dumps(job))
+        job_file.close()
+        os.rename(running_filename, scheduler.job_filename(state, job_id))
+
+def run_local_scheduler(queue_path, workers, poll_interval = 1., exit_when_idle = False):
+    LocalScheduler(os.devnull, queue_path)
+    print 'Local scheduler: %s workers on %s' % (workers, os.path.abspath(queue_path))
+    processes = [multiprocessing.Process(target = run_local_worker, args = (os.path.abspath(queue_path), poll_interval, exit_when_idle))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+backends = {'lsf' : LSF, 'condor' : HTCondor, 'slurm' : Slurm, 'local' : LocalScheduler}
+
+def get_batch_system(name, jobs_filename = 'submitted_jobs.jsonl', queue_path = 'local_queue'):
+    if not name in backends:
+        print 'Unknown batch system %s, available: %s' % (name, ', '.join(sorted(backends.keys())))
+        sys.exit(1)
+    if name == 'local':
+        return LocalScheduler(jobs_filename, queue_path)
+    return backends[name](jobs_filename)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option( "-q", "--queue_path", dest = "queue_path", default = 'local_queue',
+                  help = "Set the queue directory of the local scheduler (default: local_queue)" )
+    parser.add_option( "-n", "--workers", dest = "workers", default = multiprocessing.cpu_count(),
+                  help = "Number of jobs run at the same time (default: number of cores)" )
+    parser.add_option( "-e", "--exit_when_idle", action = "store_true", dest = "exit_when_idle",
+                  help = "Stop the workers once the queue is empty instead of waiting for new jobs" )
+
+    ( options, args ) = parser.parse_args()
+
+    run_local_scheduler(options.queue_path, int(options.workers), exit_when_idle = options.exit_when_idle)
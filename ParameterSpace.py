@@ -2,19 +2,42 @@ import sys
 import math
 import numpy as np
 
-class ParameterSpace :
+# field layout shared by ParameterSpace records and ParameterGrid structured arrays
+record_fields = ('mV', 'mDM', 'a_r', 'g', 'G_tot', 'BR', 'm_top')
+record_dtype = np.dtype([(field, np.float64) for field in record_fields])
+
+# number of significant digits kept when comparing/hashing points
+key_precision = 6
+
+def quantise(value):
+    if np.isnan(value):
+        return None
+    return float('%.*g' % (key_precision, value))
+
+class ParameterSpace(object) :
+    __slots__ = record_fields
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_record())
+
+    # equality and hashing go through the same quantised key, so points can be used in sets and as dict keys
+    def key(self):
+        return tuple(quantise(getattr(self, field)) for field in record_fields)
+
+    def __eq__(self, other):
+        return self.key() == other.key()
 
-    def __eq__(self, other): 
-        first = np.array(self.__dict__.values())
-        second = np.array(other.__dict__.values())
-        return np.allclose(first, second)
-    
     def __ne__(self, other):
-        first = np.array(self.__dict__.values())
-        second = np.array(other.__dict__.values())
-        return not np.allclose(first, second)
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key())
+
+    # tolerance-based comparison, e.g. for analytical vs MadGraph calculated parameters
+    def isclose(self, other):
+        first = np.array(self.as_tuple())
+        second = np.array(other.as_tuple())
+        return np.allclose(first, second)
 
     def __init__(self) :
         self.mV = 0
@@ -24,7 +47,26 @@ class ParameterSpace :
         self.G_tot = np.nan
         self.BR = np.nan
         self.m_top = 172
-    
+
+    def as_tuple(self):
+        return tuple(getattr(self, field) for field in record_fields)
+
+    # plain dictionary of all parameters (e.g. for the JSON output)
+    def to_record(self):
+        return dict((field, getattr(self, field)) for field in record_fields)
+
+    # accepts a dictionary or a row of a record_dtype structured array
+    @classmethod
+    def from_record(cls, record):
+        parameters = cls()
+        for field in record_fields:
+            try:
+                value = record[field]
+            except (KeyError, ValueError):
+                continue
+            setattr(parameters, field, float(value))
+        return parameters
+
     # Setting parameters
     def set_mV(self, mV):
         self.mV = float(mV)
@@ -57,38 +99,18 @@ class ParameterSpace :
         print 'BR_{DM} = ', self.BR
         print 'G_tot = ', self.G_tot
 
-    def parameter_space_name(self):
-        name = 'mV%.0f_mDM%.0f_a_r%.2f' % (self.mV, self.mDM, self.a_r)
+    # name of the point after its input parameters, with digits decimals for the couplings, BR and width
+    def parameter_space_name(self, digits = 2):
+        name = 'mV%.0f_mDM%.0f_a_r%.*f' % (self.mV, self.mDM, digits, self.a_r)
         if not np.isnan(self.g):
-            name += '_g%.2f' % self.g
+            name += '_g%.*f' % (digits, self.g)
         elif not np.isnan(self.BR):
-            name += '_BR%.2f' % self.BR
+            name += '_BR%.*f' % (digits, self.BR)
         elif not np.isnan(self.G_tot):
-            name += '_G_tot%.2f' % self.G_tot
+            name += '_G_tot%.*f' % (digits, self.G_tot)
 
         return str(name)
 
-    def mV(self):
-        return self.mV
-
-    def mDM(self):
-        return self.mDM
-
-    def a_r(self):
-        return self.a_r
-
-    def G_tot(self):
-        return self.G_tot
-
-    def g(self):
-        return self.g
-
-    def BR(self):
-        return self.BR
-
-    def m_top(self):
-        return self.m_top
-
     # ratio of top mass to mediator mass
     def r_t(self):
         return float(self.m_top/self.mV)
@@ -116,7 +138,7 @@ class ParameterSpace :
         elif not np.isnan(self.g):
             return self.g**2 * (self.mV/(12*math.pi)) * self.phi_invis()
         elif not np.isnan(self.BR):
-            calculate_g()
+            self.calculate_g()
             return self.g**2 * (self.mV/(12*math.pi)) * self.phi_invis()
         else:
             print 'Error: can not calculate the invisible decay width, please set the total width, g coupling or the BR to invisible.'
@@ -183,3 +205,138 @@ class ParameterSpace :
             self.calculate_g()
             self.calculate_BR()
 
+
+
+# vectorised companion of ParameterSpace: the same width/coupling/BR relations
+# evaluated on whole arrays of points at once
+class ParameterGrid :
+    def __init__(self, mV, mDM, a_r, g = None, BR = None, G_tot = None, m_top = 172):
+        given = [value is not None for value in [g, BR, G_tot]]
+        if sum(given) != 1:
+            print 'Error: please set exactly one of the g coupling, the BR to invisible or the total width.'
+            sys.exit(1)
+
+        nan = np.array(np.nan)
+        arrays = np.broadcast_arrays(np.asarray(mV, dtype=float), np.asarray(mDM, dtype=float), np.asarray(a_r, dtype=float),
+                                     nan if g is None else np.asarray(g, dtype=float),
+                                     nan if BR is None else np.asarray(BR, dtype=float),
+                                     nan if G_tot is None else np.asarray(G_tot, dtype=float))
+        # flat, writable copies of the broadcast inputs
+        self.mV, self.mDM, self.a_r, self.g, self.BR, self.G_tot = [np.array(array, dtype=float).ravel() for array in arrays]
+        self.shape = arrays[0].shape
+        self.m_top = float(m_top)
+        self.unphysical = np.zeros(self.mV.shape, dtype=bool)
+
+    # Cartesian product of the given axes, e.g. a 4D (mV, mDM, a_r, g) scan
+    @classmethod
+    def from_mesh(cls, mV, mDM, a_r, g = None, BR = None, G_tot = None, m_top = 172):
+        axes = [np.atleast_1d(np.asarray(axis, dtype=float)) for axis in [mV, mDM, a_r, g, BR, G_tot] if axis is not None]
+        mesh = np.meshgrid(*axes, indexing='ij')
+        kwargs = {}
+        for name, value in zip(['g', 'BR', 'G_tot'], [g, BR, G_tot]):
+            if value is not None:
+                kwargs[name] = mesh[3]
+        return cls(mesh[0], mesh[1], mesh[2], m_top=m_top, **kwargs)
+
+    def __len__(self):
+        return len(self.mV)
+
+    # ratio of top mass to mediator mass
+    def r_t(self):
+        return self.m_top/self.mV
+
+    # ratio of DM mass to mediator mass
+    def r_chi(self):
+        return self.mDM/self.mV
+
+    # phase space function for visible decay
+    def phi_vis(self):
+        r_t = self.r_t()
+        return (1-r_t**2) * (1-0.5*r_t**2-0.5*r_t**4)
+
+    # phase space function for invisible decay, nan above the mDM = mV/2 threshold
+    def phi_invis(self):
+        r_chi = self.r_chi()
+        with np.errstate(invalid='ignore'):
+            return np.sqrt(1-4*r_chi**2) * (1+2*r_chi**2)
+
+    # visible partial width
+    def G_vis(self):
+        return self.a_r**2 * (self.mV/math.pi) * self.phi_vis()
+
+    # invisible partial width, requires g to be known (see calculate_all)
+    def G_invis(self):
+        return self.g**2 * (self.mV/(12*math.pi)) * self.phi_invis()
+
+    # fills g, G_tot and BR for all points and returns the mask of unphysical points
+    def calculate_all(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            G_vis = self.G_vis()
+            phi_invis = self.phi_invis()
+            unphysical = 2*self.mDM > self.mV
+
+            if not np.all(np.isnan(self.g)):
+                g_squared = self.g**2
+            elif not np.all(np.isnan(self.BR)):
+                g_squared = 12 * self.a_r**2 * (self.BR/(1-self.BR)) * self.phi_vis() / phi_invis
+            else:
+                g_squared = (self.G_tot-G_vis)/((self.mV/(12*math.pi)) * phi_invis)
+
+            unphysical |= g_squared < 0
+            unphysical |= ~np.isfinite(g_squared)
+            self.g = np.where(unphysical, np.nan, np.sqrt(np.abs(g_squared)))
+
+            G_invis = self.G_invis()
+            self.G_tot = G_vis + G_invis
+            self.BR = G_invis/self.G_tot
+
+        self.unphysical = unphysical
+        return unphysical
+
+    # structured array with one record_dtype row per point
+    def to_records(self):
+        records = np.empty(len(self), dtype=record_dtype)
+        for field in record_fields:
+            records[field] = getattr(self, field)
+        return records
+
+    # scalar ParameterSpace instance for a single point of the grid
+    def parameter_space(self, index):
+        return ParameterSpace.from_record(self.to_records()[index])
+
+    # inverse problem: a_r (g_SM) giving the requested pair of g, BR and G_tot at each (mV, mDM),
+    # e.g. the narrow width border G_tot = 0.1*mV for a fixed g or BR. All combinations are closed form.
+    @classmethod
+    def solve_a_r(cls, mV, mDM, g = None, BR = None, G_tot = None, m_top = 172):
+        given = [value is not None for value in [g, BR, G_tot]]
+        if sum(given) != 2:
+            print 'Error: please set exactly two of the g coupling, the BR to invisible or the total width.'
+            sys.exit(1)
+
+        nan = np.array(np.nan)
+        mV, mDM, g_array, BR_array, G_tot_array = np.broadcast_arrays(*[nan if value is None else np.asarray(value, dtype=float)
+                                                                        for value in [mV, mDM, g, BR, G_tot]])
+        # a_r is solved for below, the zeros only fix the shape
+        grid = cls(mV, mDM, np.zeros(mV.shape), g=g_array, m_top=m_top)
+        BR_array = BR_array.ravel()
+        G_tot_array = G_tot_array.ravel()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # visible width per unit a_r**2
+            G_vis_unit = (grid.mV/math.pi) * grid.phi_vis()
+            if g is None:
+                G_vis = G_tot_array * (1-BR_array)
+                grid.g = np.sqrt(np.abs(BR_array * G_tot_array / ((grid.mV/(12*math.pi)) * grid.phi_invis())))
+            elif BR is None:
+                G_vis = G_tot_array - grid.G_invis()
+            else:
+                G_vis = grid.G_invis() * (1-BR_array) / BR_array
+            a_r_squared = G_vis / G_vis_unit
+
+        grid.a_r = np.sqrt(np.abs(a_r_squared))
+        with np.errstate(invalid='ignore'):
+            unphysical = grid.calculate_all() | (a_r_squared < 0) | ~np.isfinite(a_r_squared)
+        grid.a_r[unphysical] = np.nan
+        grid.unphysical = unphysical
+        return grid
+
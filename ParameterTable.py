@@ -0,0 +1,98 @@
+# this script converts parameter tables (make_results_table.py output, e.g. parameter_tables/*.csv) into the binary format
+# A table is written as CSV and, next to it, as a NumPy structured array (<name>.npy, named float64 columns) with a description
+# of the scan (<name>.npy.json: columns, number of points, processes and the values of the scanned parameters).
+# The binary table is loaded memory-mapped, so that large scans open instantly and the columns are accessed by name.
+
+import os, sys
+import csv, json
+import numpy as np
+from optparse import OptionParser
+
+# columns of a parameter table: the parameters of the point and the cross-section of every process
+parameter_columns = ['BR', 'G_tot', 'a_r', 'g', 'mDM', 'mV']
+
+def table_columns(processes):
+    return parameter_columns + ['xsection_' + process for process in sorted(processes)]
+
+def binary_filename(filename):
+    return os.path.splitext(filename)[0] + '.npy'
+
+def metadata_filename(filename):
+    return binary_filename(filename) + '.json'
+
+# structured array from a dictionary of columns
+def make_table(columns, column_names):
+    table = np.empty(len(columns[column_names[0]]), dtype = [(name, np.float64) for name in column_names])
+    for name in column_names:
+        table[name] = columns[name]
+    return table
+
+# values of the scanned parameters (mV, mDM, a_r and g or BR) and the processes of a table
+def scan_definition(table, scanned_parameter = 'g'):
+    scan = {'scanned_parameter' : scanned_parameter,
+            'processes' : [name[len('xsection_'):] for name in table.dtype.names if name.startswith('xsection_')]}
+    for field in ['mV', 'mDM', 'a_r', scanned_parameter]:
+        scan[field] = np.unique(table[field]).tolist()
+    return scan
+
+# binary copy of the table of a CSV file, and its description
+def write_binary_table(table, filename, scan = None):
+    with open(binary_filename(filename) + '.tmp', 'wb') as f:
+        np.save(f, table)
+    os.rename(binary_filename(filename) + '.tmp', binary_filename(filename))
+
+    metadata = {'table' : os.path.basename(filename), 'columns' : list(table.dtype.names), 'dtype' : table.dtype.descr,
+                'number_of_points' : len(table), 'scan' : scan}
+    with open(metadata_filename(filename), 'w') as f:
+        f.write(json.dumps(metadata, indent = 4, sort_keys = True))
+
+# writes the CSV table and its binary copy, both replaced by a rename
+def write_table(table, filename, scan = None):
+    with open(filename + '.tmp', 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
+    os.rename(filename + '.tmp', filename)
+    write_binary_table(table, filename, scan)
+
+# structured array of a table (CSV or .npy): the binary copy of a CSV table is used if it is not older than the CSV,
+# memory-mapped (read-only) unless mmap is False
+def read_table(filename, mmap = True):
+    mmap_mode = None
+    if mmap:
+        mmap_mode = 'r'
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode = mmap_mode)
+    binary = binary_filename(filename)
+    if os.path.isfile(binary) and (not os.path.isfile(filename) or os.path.getmtime(binary) >= os.path.getmtime(filename)):
+        return np.load(binary, mmap_mode = mmap_mode)
+    return np.genfromtxt(filename, delimiter = ',', names = True)
+
+# description of the table and its scan, None for a table without binary copy or with a binary copy older than the CSV
+# (as read_table then reads the CSV)
+def read_metadata(filename):
+    if not os.path.isfile(metadata_filename(filename)):
+        return None
+    if not filename.endswith('.npy') and os.path.isfile(filename) and os.path.getmtime(metadata_filename(filename)) < os.path.getmtime(filename):
+        return None
+    with open(metadata_filename(filename), 'r') as f:
+        return json.load(f)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage = 'usage: %prog [options] table.csv [table.csv ...]')
+    parser.add_option( "-B", "--BR_parameters", action = "store_true", dest = "BR_run",
+                  help = "The tables are BR scans (default: tables with BR in their name)" )
+
+    ( options, args ) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    for filename in args:
+        table = np.genfromtxt(filename, delimiter = ',', names = True)
+        scanned_parameter = 'g'
+        if options.BR_run or 'BR' in os.path.basename(filename):
+            scanned_parameter = 'BR'
+        write_binary_table(table, filename, scan_definition(table, scanned_parameter))
+        print 'Binary table of %s points written into %s' % (len(table), binary_filename(filename))
@@ -0,0 +1,166 @@
+import os
+import json
+import sqlite3
+import numpy as np
+from ParameterSpace import quantise
+
+# columns identifying a physics point, g/BR/G_tot are all stored so that a point can be looked up by any of them
+point_fields = ('mV', 'mDM', 'a_r', 'g', 'BR', 'G_tot')
+
+# fields every output of calculate_MG_xsection.py has, with finite values
+output_fields = ['mV', 'mDM', 'a_r', 'g', 'BR', 'G_tot', 'xsection']
+
+# results are written either as one JSON file per point and subprocess, or appended as JSON lines to shards (one per job or worker)
+JSON_extension = '.txt'
+shard_extension = '.jsonl'
+
+# True for a complete output of calculate_MG_xsection.py
+def valid_result(data):
+    if not isinstance(data, dict) or not 'process' in data:
+        return False
+    try:
+        return all(np.isfinite(float(data[field])) for field in output_fields)
+    except (KeyError, TypeError, ValueError):
+        return False
+
+# results of a shard from the byte offset on, as (data, offset after its line), data is None for a corrupt line.
+# A last line without newline is still being written and is left for the next reading.
+def read_shard(filename, offset = 0):
+    input_file = open(filename, 'rb')
+    input_file.seek(offset)
+    for line in input_file:
+        if not line.endswith('\n'):
+            break
+        offset += len(line)
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = None
+        if data is not None and not valid_result(data):
+            data = None
+        yield data, offset
+    input_file.close()
+
+# result files of a directory (JSON files and shards), ordered by name
+def result_files(input_path):
+    return [os.path.join(input_path, filename) for filename in sorted(os.listdir(input_path))
+            if filename.endswith(shard_extension) or (filename.endswith(JSON_extension) and os.path.isfile(os.path.join(input_path, filename)))]
+
+# valid results of a JSON file or a shard (from the byte offset on), the number of corrupt or incomplete ones
+# and the offset up to which the shard has been read
+def read_result_file(filename, offset = 0):
+    results = []
+    corrupt = 0
+    if filename.endswith(shard_extension):
+        for data, offset in read_shard(filename, offset):
+            if data is None:
+                corrupt += 1
+            else:
+                results.append(data)
+        return results, corrupt, offset
+    try:
+        input_file = open(filename, 'r')
+        data = json.load(input_file)
+        input_file.close()
+    except ValueError:
+        data = None
+    if valid_result(data):
+        return [data], 0, 0
+    return [], 1, 0
+
+# all valid results of a directory, one file at a time
+def read_results(input_path):
+    corrupt = 0
+    for filename in result_files(input_path):
+        results, file_corrupt, offset = read_result_file(filename)
+        corrupt += file_corrupt
+        for data in results:
+            yield data
+    if corrupt:
+        print 'Warning: skipped %s corrupt or incomplete results in %s' % (corrupt, input_path)
+
+class ResultStore(object) :
+    def __init__(self, filename, timeout = 600):
+        self.filename = filename
+        # long timeout: several local jobs may be writing at the same time
+        self.connection = sqlite3.connect(filename, timeout = timeout)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                process TEXT, mV REAL, mDM REAL, a_r REAL, g REAL, BR REAL, G_tot REAL,
+                model_version TEXT, MG_version TEXT, data TEXT,
+                PRIMARY KEY (process, mV, mDM, a_r, g, model_version, MG_version))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_BR ON results (process, mV, mDM, a_r, BR)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_G_tot ON results (process, mV, mDM, a_r, G_tot)')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    # data: dictionary as written into the JSON output (parameters, xsection, process)
+    def put(self, data, model_version = '', MG_version = '', commit = True):
+        key = [quantise(float(data[field])) for field in point_fields]
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [data['process']] + key + [model_version, MG_version, json.dumps(data, sort_keys = True)])
+        if commit:
+            self.connection.commit()
+
+    # the point is selected by mV, mDM, a_r and whichever of g, BR or G_tot is given,
+    # versions set to None match any version
+    def get(self, process, mV, mDM, a_r, g = None, BR = None, G_tot = None, model_version = None, MG_version = None):
+        query = 'SELECT data FROM results WHERE process = ? AND mV = ? AND mDM = ? AND a_r = ?'
+        values = [process, quantise(float(mV)), quantise(float(mDM)), quantise(float(a_r))]
+        for field, value in zip(['g', 'BR', 'G_tot'], [g, BR, G_tot]):
+            if value is not None:
+                query += ' AND %s = ?' % field
+                values.append(quantise(float(value)))
+                break
+        for field, value in zip(['model_version', 'MG_version'], [model_version, MG_version]):
+            if value is not None:
+                query += ' AND %s = ?' % field
+                values.append(value)
+        row = self.connection.execute(query, values).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def contains(self, process, mV, mDM, a_r, g = None, BR = None, G_tot = None, model_version = None, MG_version = None):
+        return self.get(process, mV, mDM, a_r, g, BR, G_tot, model_version, MG_version) is not None
+
+    # (model_version, MG_version, number of results) of all versions in the store
+    def versions(self):
+        return [tuple(row) for row in self.connection.execute('SELECT model_version, MG_version, COUNT(*) FROM results GROUP BY model_version, MG_version ORDER BY model_version, MG_version')]
+
+    # all stored results (optionally of one process), ordered by point, versions set to None match any version
+    def results(self, process = None, model_version = None, MG_version = None):
+        query = 'SELECT data FROM results'
+        conditions = []
+        values = []
+        for field, value in zip(['process', 'model_version', 'MG_version'], [process, model_version, MG_version]):
+            if value is not None:
+                conditions.append('%s = ?' % field)
+                values.append(value)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY process, mV, mDM, a_r, g'
+        return [json.loads(row[0]) for row in self.connection.execute(query, values)]
+
+    # adds outputs of calculate_MG_xsection.py (e.g. from read_results), a result of a point already in the store replaces
+    # the stored one (e.g. a rerun at the same versions). Returns the number of new and of replaced results.
+    def import_results(self, results, model_version = '', MG_version = ''):
+        imported = 0
+        replaced = 0
+        for data in results:
+            data_model_version = data.get('model_version', model_version)
+            data_MG_version = data.get('MG_version', MG_version)
+            stored = self.get(data['process'], data['mV'], data['mDM'], data['a_r'], g = data['g'], model_version = data_model_version, MG_version = data_MG_version)
+            if stored == json.loads(json.dumps(data, sort_keys = True)):
+                continue
+            self.put(data, data_model_version, data_MG_version, commit = False)
+            if stored is None:
+                imported += 1
+            else:
+                replaced += 1
+        self.connection.commit()
+        return imported, replaced
@@ -1,26 +1,100 @@
 # this script creates a MadGraph configuration file, runs Madgraph and outputs the calculated quantities for a given process
 
 import sys, os
-import json
+import json, csv
 import copy
+import shutil
+import hashlib
 import subprocess as sp
 import string
 import numpy as np
 import math
+import socket
+import resource
 from optparse import OptionParser
-from ParameterSpace import ParameterSpace
+from ParameterSpace import ParameterSpace, ParameterGrid
+from ResultStore import ResultStore, JSON_extension
 
 from time import time
 
+# CPU time of this process and of its finished children (MadGraph)
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
 class Timer():
     def __init__(self):
         self.start_time =  time()
+        self.start_cpu_time = cpu_time()
+        self.phases = {}
+        self.phase_order = []
+        self.current_phase = None
+        self.peak_RSS_MG = 0.
     def elapsed_time(self):
         return time() - self.start_time
     def restart(self):
         self.start_time =  time()
+    # ends the current phase and starts a new one, time of phases run several times (e.g. per point) is summed
+    def start_phase(self, phase):
+        self.end_phase()
+        if not phase in self.phases:
+            self.phases[phase] = {'wall_time' : 0., 'cpu_time' : 0., 'calls' : 0}
+            self.phase_order.append(phase)
+        self.phases[phase]['calls'] += 1
+        self.current_phase = (phase, time(), cpu_time())
+    def end_phase(self):
+        if self.current_phase is None:
+            return
+        phase, start_time, start_cpu_time = self.current_phase
+        self.phases[phase]['wall_time'] += time() - start_time
+        self.phases[phase]['cpu_time'] += cpu_time() - start_cpu_time
+        self.current_phase = None
+    # resource usage of a finished MadGraph run (os.wait4), including the processes it started
+    def add_MG_usage(self, usage):
+        self.peak_RSS_MG = max(self.peak_RSS_MG, usage.ru_maxrss / 1024.)
+    # machine-readable summary of all phases, peak RSS in MB (ru_maxrss is in kB on Linux): the one of the MadGraph runs
+    # of this session, and the one of this python process over its lifetime (e.g. of all sessions of a pool worker)
+    def timing_record(self):
+        self.end_phase()
+        return {
+            'host' : socket.gethostname(),
+            'start_time' : self.start_time,
+            'wall_time' : self.elapsed_time(),
+            'cpu_time' : cpu_time() - self.start_cpu_time,
+            'peak_RSS_MB' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            'peak_RSS_MG_MB' : self.peak_RSS_MG,
+            'phases' : [dict(self.phases[phase], phase = phase) for phase in self.phase_order],
+        }
+
+# waits for a MadGraph run, its peak memory is counted for the session of the timer. The RUSAGE_CHILDREN peak of this
+# process would be the one of all runs so far, e.g. of earlier jobs of a pool worker.
+def wait_for_MG(run, timer = None):
+    pid, status, usage = os.wait4(run.pid, 0)
+    if os.WIFSIGNALED(status):
+        run.returncode = -os.WTERMSIG(status)
+    else:
+        run.returncode = os.WEXITSTATUS(status)
+    if timer is not None:
+        timer.add_MG_usage(usage)
+    return run.returncode
 
 madgraph_executable = './bin/mg5_aMC'
+workspace_path = 'workspace/'
+output_path = 'output_JSON/'
+process_cache_path = 'process_cache/'
+timing_path = 'output_JSON/logs/'
+result_store = None
+result_shard = None
+model_path = 'models/MonotopDMF_UFO'
+# all subprocesses generated in one MadGraph output, tagged @1, @2, ... in this order
+combined_subprocess = 'all'
+combined_subprocesses = ['tt_exclusive', 'onshellV', 'offshellV', 'monotop']
+# number of events in the cross-section only mode, the integration stops at the requested precision
+xsection_only_nevents = 100
+# run_card values of the full mode (the MadGraph defaults), set in every launch as a reused process directory
+# keeps the run_card of its earlier runs, e.g. of a cross-section only scan
+full_run_nevents = 10000
+full_run_req_acc = -1
 
 def make_folder_if_not_exists(folder):
     if not os.path.exists(folder):
@@ -38,11 +112,80 @@ def write_data_to_JSON(data, JSON_output_file, indent = True):
     output_file.close()
 
 
-def create_MG_config(subprocess, parameters, file_name_suffix, auto_width = True):
-	global workspace_path
-	name = workspace_path + subprocess + '_' + file_name_suffix
-	filename = name + '.dat'
-	file = open(filename,'w')
+# list of points for a multi-point MadGraph session, from
+#  - a CSV table with named columns (e.g. parameter_tables/*.csv),
+#  - a JSON list of points, e.g. [{"mV": 1000, "a_r": 0.1, "g": 0.5}, ...],
+#  - a JSON grid specification, e.g. {"mV": [1000, 2000], "a_r": [0.1, 0.2], "g": [0.5, 1.0]} (Cartesian product).
+# Returns the points with all parameters calculated, their file name suffixes and whether the width is left to MG.
+def read_points(points_filename, mDM = 1):
+    input_file = open(points_filename, 'r')
+    if points_filename.endswith('.csv'):
+        rows = list(csv.DictReader(input_file))
+        columns = dict((key, [float(row[key]) for row in rows]) for key in rows[0].keys())
+        is_grid = False
+    else:
+        data = json.load(input_file)
+        is_grid = isinstance(data, dict)
+        if is_grid:
+            columns = data
+        else:
+            columns = dict((key, [float(point[key]) for point in data]) for key in data[0].keys())
+    input_file.close()
+
+    if not 'mDM' in columns:
+        columns['mDM'] = [mDM]
+        if not is_grid:
+            columns['mDM'] = [mDM] * len(columns['mV'])
+
+    # same precedence as ParameterSpace.calculate_all
+    input_parameter = None
+    for key in ['g', 'BR', 'G_tot']:
+        if key in columns:
+            input_parameter = key
+            break
+    if not input_parameter:
+        print 'Insufficient input parameters in %s, please provide the total width (G_tot), branching ratio (BR) or the g coupling constant (g).' % points_filename
+        sys.exit(1)
+
+    kwargs = {input_parameter : columns[input_parameter]}
+    if is_grid:
+        grid = ParameterGrid.from_mesh(columns['mV'], columns['mDM'], columns['a_r'], **kwargs)
+    else:
+        grid = ParameterGrid(columns['mV'], columns['mDM'], columns['a_r'], **kwargs)
+    input_values = np.copy(getattr(grid, input_parameter))
+    unphysical = grid.calculate_all()
+
+    points = []
+    input_points = []
+    for i in range(len(grid)):
+        if unphysical[i]:
+            print 'Warning: skipping unphysical point mV = %s, mDM = %s, a_r = %s, %s = %s' % (grid.mV[i], grid.mDM[i], grid.a_r[i], input_parameter, input_values[i])
+            continue
+        # name the point after its input parameters only, as for a single point
+        parameters = ParameterSpace()
+        parameters.set_mV(grid.mV[i])
+        parameters.set_mDM(grid.mDM[i])
+        parameters.set_a_r(grid.a_r[i])
+        setattr(parameters, input_parameter, float(input_values[i]))
+        input_points.append(parameters)
+        points.append(grid.parameter_space(i))
+
+    # the names have to be unique (JSON outputs, MadGraph runs): more digits are used if the points only differ beyond 2 decimals
+    for digits in range(2, 7):
+        points_suffixes = [parameters.parameter_space_name(digits) for parameters in input_points]
+        if len(set(points_suffixes)) == len(points_suffixes):
+            break
+    else:
+        duplicates = sorted(set(suffix for suffix in points_suffixes if points_suffixes.count(suffix) > 1))
+        print 'Error: %s points are given more than once in %s: %s' % (len(duplicates), points_filename, ', '.join(duplicates))
+        sys.exit(1)
+    if digits > 2:
+        print 'Points named with %s decimals, as some of them only differ beyond 2 decimals' % digits
+
+    return points, points_suffixes, input_parameter != 'G_tot'
+
+
+def write_MG_header(file):
 	file.write('#************************************************************\n')
 	file.write('#*                        MadGraph 5                        *\n')
 	file.write('#*                                                          *\n')
@@ -63,39 +206,142 @@ def create_MG_config(subprocess, parameters, file_name_suffix, auto_width = True
 	file.write('#*     run as ./bin/mg5  filename                           *\n')
 	file.write('#*                                                          *\n')
 	file.write('#************************************************************\n')
-	file.write('set automatic_html_opening False\n')
-	file.write('import model models/MonotopDMF_UFO -modelname\n')
-	file.write('define j = g u c d s b u~ c~ d~ s~ b~\n')
-	file.write('define l+ = e+ mu+ ta+\n')
-	file.write('define l- = e- mu- ta-\n')
-	file.write('define vl = ve vm vt\n')
-	file.write('define vl~ = ve~ vm~ vt~\n')
-	file.write('\n')
+
+# process generation lines for a given subprocess, each line tagged with the process number tag if given
+def subprocess_generation(subprocess, tag = 0):
+	lines = []
 	if 'tt_excl' in subprocess:
-		file.write('# tt exclusive decay\n')
-		file.write('generate p p > t t, (t > b W+, W+ > l+ vl)\n')
-		file.write('add process p p > t~ t~, (t~ > b~ W-, W- > l- vl~)\n')
-		file.write('\n')
+		lines.append('# tt exclusive decay\n')
+		processes = ['p p > t t, (t > b W+, W+ > l+ vl)', 'p p > t~ t~, (t~ > b~ W-, W- > l- vl~)']
 	elif 'onshell' in subprocess:
-		file.write('# Visible on-shell V decay\n')
-		file.write('generate p p > V > t t u~, (t > b W+, W+ > l+ vl)\n')
-		file.write('add process p p > V > t~ t~ u, (t~ > b~ W-, W- > l- vl~)\n')
-		file.write('\n')
+		lines.append('# Visible on-shell V decay\n')
+		processes = ['p p > V > t t u~, (t > b W+, W+ > l+ vl)', 'p p > V > t~ t~ u, (t~ > b~ W-, W- > l- vl~)']
 	elif 'offshell' in subprocess:
-		file.write('# Off-shell V decay\n')
-		file.write('generate p p > t t u~ $$ V, (t > b W+, W+ > l+ vl)\n')
-		file.write('add process p p > t~ t~ u $$ V, (t~ > b~ W-, W- > l- vl~)\n')
-		file.write('\n')
+		lines.append('# Off-shell V decay\n')
+		processes = ['p p > t t u~ $$ V, (t > b W+, W+ > l+ vl)', 'p p > t~ t~ u $$ V, (t~ > b~ W-, W- > l- vl~)']
 	elif 'Monotop' in subprocess or 'monotop' in subprocess:
-		file.write('# Monotop\n')
-		file.write('generate p p > t psi psibar, (t > b W+, W+ > l+ vl)\n')
-		file.write('add process p p > t~ psi psibar, (t~ > b~ W-, W- > l- vl~)\n')
-		file.write('\n')
-
+		lines.append('# Monotop\n')
+		processes = ['p p > t psi psibar, (t > b W+, W+ > l+ vl)', 'p p > t~ psi psibar, (t~ > b~ W-, W- > l- vl~)']
+	else:
+		print 'Unknown subprocess: ', subprocess
+		sys.exit(1)
+	if tag:
+		processes = [process + ' @%d' % tag for process in processes]
+	return lines, processes
+
+# model import and process generation lines for a given subprocess,
+# the combined subprocess generates all subprocesses at once (tagged, to get the cross-section of each)
+def process_definition(subprocess):
+	lines = []
+	lines.append('set automatic_html_opening False\n')
+	lines.append('import model %s -modelname\n' % model_path)
+	lines.append('define j = g u c d s b u~ c~ d~ s~ b~\n')
+	lines.append('define l+ = e+ mu+ ta+\n')
+	lines.append('define l- = e- mu- ta-\n')
+	lines.append('define vl = ve vm vt\n')
+	lines.append('define vl~ = ve~ vm~ vt~\n')
+	lines.append('\n')
+	if subprocess == combined_subprocess:
+		tagged_subprocesses = [(single_subprocess, tag+1) for tag, single_subprocess in enumerate(combined_subprocesses)]
+	else:
+		tagged_subprocesses = [(subprocess, 0)]
+	command = 'generate'
+	for single_subprocess, tag in tagged_subprocesses:
+		comment_lines, processes = subprocess_generation(single_subprocess, tag)
+		lines += comment_lines
+		for process in processes:
+			lines.append('%s %s\n' % (command, process))
+			command = 'add process'
+		lines.append('\n')
+	return lines
+
+# content hash of the model files
+def model_version(base_path = '.'):
+	md5 = hashlib.md5()
+	for root, dirs, files in sorted(os.walk(base_path + '/' + model_path)):
+		dirs.sort()
+		for model_file in sorted(files):
+			if model_file.endswith('.pyc'):
+				continue
+			with open(os.path.join(root, model_file), 'rb') as f:
+				md5.update(f.read())
+	return md5.hexdigest()
+
+# MadGraph version, from the VERSION file of the MadGraph directory
+def MG_version(base_path = '.'):
+	version = ''
+	if os.path.isfile(base_path + '/VERSION'):
+		for line in open(base_path + '/VERSION', 'r').readlines():
+			if line.startswith('version'):
+				version = line.split('=')[-1].strip()
+	return version
+
+def process_cache_key(subprocess):
+	md5 = hashlib.md5()
+	md5.update(''.join(process_definition(subprocess)))
+	md5.update(model_version())
+	md5.update(MG_version())
+	return md5.hexdigest()[:12]
+
+# MadEvent run names can not contain dots
+# the index of the point in the session keeps the names unique even for points with the same name
+def MG_run_name(file_name_suffix, index = 0):
+	return 'run_%04d_' % index + file_name_suffix.replace('.', 'p')
+
+# returns the compiled MadEvent directory for a subprocess, generating it once per process definition and model version
+def get_cached_process_directory(subprocess, timer = None):
+	global process_cache_path
+	process_directory = os.path.abspath(process_cache_path + subprocess + '_' + process_cache_key(subprocess))
+	if os.path.isdir(process_directory):
+		print 'Reusing MadEvent process directory ', process_directory
+		return process_directory
+
+	make_folder_if_not_exists(process_cache_path)
+	# generate under a temporary name and rename, so that concurrent jobs never see a half-written directory
+	temporary_directory = process_directory + '_tmp%d' % os.getpid()
+	config_filename = temporary_directory + '.dat'
+	file = open(config_filename, 'w')
+	write_MG_header(file)
+	for line in process_definition(subprocess):
+		file.write(line)
 	file.write('# Output processes to MadEvent directory\n')
-	file.write('output %s\n' % name)
-	file.write('\n')
-	file.write('launch %s\n' % name)
+	file.write('output %s\n' % temporary_directory)
+	file.close()
+
+	print 'Generating MadEvent process directory ', process_directory
+	output_file = open(temporary_directory + '.out', 'w')
+	run = sp.Popen([madgraph_executable, config_filename], cwd='./', stdout=output_file)
+	wait_for_MG(run, timer)
+	output_file.close()
+
+	if not os.path.isdir(temporary_directory):
+		print 'Error: MadGraph failed to create the process directory, see ', temporary_directory + '.out'
+		sys.exit(1)
+	try:
+		os.rename(temporary_directory, process_directory)
+		os.rename(config_filename, process_directory + '.dat')
+		os.rename(temporary_directory + '.out', process_directory + '.out')
+	except OSError:
+		# another job has been faster
+		shutil.rmtree(temporary_directory)
+	return process_directory
+
+# launch block for a single point: answers the card questions with the new param_card values
+# precision: relative precision of the integration in the cross-section only mode, 0 for the default event generation
+def write_MG_launch(file, launch_target, parameters, auto_width = True, run_name = None, precision = 0):
+	if run_name:
+		file.write('launch %s -n %s\n' % (launch_target, run_name))
+	else:
+		file.write('launch %s\n' % launch_target)
+	if precision:
+		# cross-section only: a minimal unweighted sample, no systematics, integration to the requested precision
+		file.write('set nevents %d\n' % xsection_only_nevents)
+		file.write('set req_acc %e\n' % precision)
+		file.write('set use_syst False\n')
+	else:
+		file.write('set nevents %d\n' % full_run_nevents)
+		file.write('set req_acc %d\n' % full_run_req_acc)
+		file.write('set use_syst True\n')
 	file.write('set Mpsi %e # changing the psi mass\n' % parameters.mDM)
 	file.write('set ar %e # changing the a_r coupling constant\n' % parameters.a_r)
 	file.write('set gg %e # changing the gg coupling constant\n' % parameters.g)
@@ -104,12 +350,72 @@ def create_MG_config(subprocess, parameters, file_name_suffix, auto_width = True
 		file.write('set WV Auto # changing the V width\n')
 	else:
 		file.write('set WV %e # changing the V width\n' % parameters.G_tot)
-	file.write('launch %s -i\n' % name)
+
+# remove a previous run with the same name from a reused process directory
+def clean_MG_run(process_directory, run_name):
+	previous_run = process_directory + '/Events/' + run_name
+	if os.path.isdir(previous_run):
+		shutil.rmtree(previous_run)
+
+def create_MG_config(subprocess, parameters, file_name_suffix, auto_width = True, process_directory = None, nb_core = 0, precision = 0):
+	create_MG_batch_config(subprocess, [parameters], [file_name_suffix], file_name_suffix, auto_width, process_directory, nb_core, precision)
+
+# one MadGraph session for many points: the process is generated (or taken from the cache) once
+# and followed by one launch block per point, auto_width can also be given per point (list)
+def create_MG_batch_config(subprocess, points, points_suffixes, file_name_suffix, auto_width = True, process_directory = None, nb_core = 0, precision = 0):
+	auto_widths = auto_width
+	if not isinstance(auto_width, list):
+		auto_widths = [auto_width]*len(points)
+	global workspace_path
+	name = workspace_path + subprocess + '_' + file_name_suffix
+	filename = name + '.dat'
+	file = open(filename,'w')
+	write_MG_header(file)
+	if nb_core:
+		# multicore mode with a fixed number of cores, to not oversubscribe a node running several MG jobs
+		file.write('set run_mode 2\n')
+		file.write('set nb_core %d\n' % nb_core)
+	if process_directory:
+		# only update the param_card of the already compiled process
+		launch_target = process_directory
+	else:
+		launch_target = name
+		for line in process_definition(subprocess):
+			file.write(line)
+		file.write('# Output processes to MadEvent directory\n')
+		file.write('output %s\n' % name)
+		file.write('\n')
+	for i, (parameters, points_suffix, point_auto_width) in enumerate(zip(points, points_suffixes, auto_widths)):
+		run_name = None
+		if process_directory:
+			run_name = MG_run_name(points_suffix, i)
+			clean_MG_run(process_directory, run_name)
+		write_MG_launch(file, launch_target, parameters, point_auto_width, run_name, precision)
+	file.write('launch %s -i\n' % launch_target)
 	file.write('print_results --path=%s.txt --format=short\n' % name)
 
-	file.close
+	file.close()
 
-def run_MG_config(subprocess, parameters, file_name_suffix, auto_width = True):
+# MadEvent directory and run names holding the banner of each point of a (batch) config
+def MG_runs(subprocess, points_suffixes, file_name_suffix, process_directory = None):
+	global workspace_path
+	if process_directory:
+		return [(process_directory, MG_run_name(points_suffix, i)) for i, points_suffix in enumerate(points_suffixes)]
+	name = workspace_path + subprocess + '_' + file_name_suffix
+	return [(name, 'run_%02d' % (i+1)) for i in range(len(points_suffixes))]
+
+# lines of the MadGraph output starting a new phase of the run (the first phase is the process output,
+# or the launch for an already compiled process). The CPU time of MadGraph is only known once it exits,
+# so it is accounted in its last phase.
+MG_phase_markers = [
+	('MG_launch', 'Output to directory'),
+	('MG_compile', 'compile Source'),
+	('MG_survey', 'Running Survey'),
+	('MG_refine', 'Refine results'),
+	('MG_combine', 'Combining Events'),
+]
+
+def run_MG_config(subprocess, parameters, file_name_suffix, auto_width = True, timer = None, first_phase = 'MG_output'):
 	global workspace_path
 	name = workspace_path + subprocess + '_' + file_name_suffix
 	config_filename = name + '.dat'
@@ -117,19 +423,75 @@ def run_MG_config(subprocess, parameters, file_name_suffix, auto_width = True):
 	output_file = open(output_filename,'w')
 	print 'Executing command: ', madgraph_executable + ' ./' + config_filename
 	print 'Output file: ', output_filename
-	run = sp.Popen([madgraph_executable, config_filename], cwd='./', stdout=output_file)
-	run.communicate()
-	output_file.close
-
-def read_MG_output(subprocess, parameters, file_name_suffix, auto_width = True, overwrite_with_MG = False):
+	if timer is None:
+		run = sp.Popen([madgraph_executable, config_filename], cwd='./', stdout=output_file)
+		run.communicate()
+		output_file.close()
+		return
+	# follow the output to time the MadGraph phases
+	timer.start_phase(first_phase)
+	run = sp.Popen([madgraph_executable, config_filename], cwd='./', stdout=sp.PIPE)
+	for line in iter(run.stdout.readline, ''):
+		output_file.write(line)
+		for phase, marker in MG_phase_markers:
+			if marker in line:
+				timer.start_phase(phase)
+	wait_for_MG(run, timer)
+	timer.end_phase()
+	output_file.close()
+
+# banner of the last launch of a run: MadEvent counts up the tag (run_01_tag_2_banner.txt) when a run name is launched
+# again in the same process directory, e.g. by the next session over a cached process directory
+def MG_banner_filename(process_directory, run_name):
+	run_directory = process_directory + '/Events/' + run_name + '/'
+	banner_prefix = run_name + '_tag_'
+	tags = [1]
+	if os.path.isdir(run_directory):
+		for filename in os.listdir(run_directory):
+			if filename.startswith(banner_prefix) and filename.endswith('_banner.txt'):
+				try:
+					tags.append(int(filename[len(banner_prefix):-len('_banner.txt')]))
+				except ValueError:
+					continue
+	return run_directory + banner_prefix + '%d_banner.txt' % max(tags)
+
+# integration uncertainties [pb] by run name from the print_results (short format) output, the banner only has the cross-section;
+# a run launched again is listed once per tag, in order, so the last launch is kept
+def read_MG_uncertainties(subprocess, file_name_suffix):
+	global workspace_path
+	results_filename = workspace_path + subprocess + '_' + file_name_suffix + '.txt'
+	uncertainties = {}
+	if not os.path.isfile(results_filename):
+		return uncertainties
+	results_file = open(results_filename, 'r')
+	for line in results_file.readlines():
+		columns = string.split(line)
+		if len(columns) < 4 or line.startswith('#'):
+			continue
+		try:
+			uncertainties[columns[0]] = float(columns[3])
+		except ValueError:
+			continue
+	results_file.close()
+	return uncertainties
+
+def read_MG_output(subprocess, parameters, file_name_suffix, auto_width = True, overwrite_with_MG = False, process_directory = None, run_name = 'run_01', timer = None, xsection_uncertainty = None):
 	global workspace_path, output_path
-	name = workspace_path + subprocess + '_' + file_name_suffix
-	output_banner_filename = name + '/Events/run_01/run_01_tag_1_banner.txt'
+	if timer is not None:
+		timer.start_phase('banner_parsing')
+	if not process_directory:
+		process_directory = workspace_path + subprocess + '_' + file_name_suffix
+	output_banner_filename = MG_banner_filename(process_directory, run_name)
 	output_banner = open(output_banner_filename,'r')
 
 	# new parameters instance for MG-calculated quantities
 	parameters_MG = ParameterSpace()
 
+	# cross-sections and uncertainties by process number tag from the LHE init block
+	tagged_cross_sections = {}
+	in_init_block = False
+	init_lines = 0
+
 	# parse the output for numbers
 	for line in output_banner.readlines():
 		columns = string.split(line)
@@ -147,8 +509,17 @@ def read_MG_output(subprocess, parameters, file_name_suffix, auto_width = True,
 			parameters_MG.set_BR(columns[0])
 		if 'Integrated weight (pb)' in line:
 			cross_section = float(columns[-1])
-
-	output_banner.close
+		if '</init>' in line:
+			in_init_block = False
+		if in_init_block:
+			# after the beam line: cross-section, uncertainty, maximum weight and process number tag
+			if init_lines > 0 and len(columns) == 4:
+				tagged_cross_sections[int(columns[3])] = (float(columns[0]), float(columns[1]))
+			init_lines += 1
+		if '<init>' in line:
+			in_init_block = True
+
+	output_banner.close()
 
 	print '*'*100
 	print 'MadGraph calculated quantities:'
@@ -163,21 +534,279 @@ def read_MG_output(subprocess, parameters, file_name_suffix, auto_width = True,
             print 'Using analytically calculated parameters in the output.'
             output_parameters = parameters
 
-	data_to_write = copy.copy(output_parameters.__dict__)
+	if timer is not None:
+		timer.start_phase('JSON_write')
+	if subprocess == combined_subprocess:
+		# one output per subprocess, as for separate runs
+		for tag, single_subprocess in enumerate(combined_subprocesses):
+			if not tag+1 in tagged_cross_sections:
+				print 'Error: no cross-section for %s (tag @%d) in ' % (single_subprocess, tag+1), output_banner_filename
+				sys.exit(1)
+			single_cross_section, single_uncertainty = tagged_cross_sections[tag+1]
+			print 'Calculated cross-section [pb] for %s = %s' % (single_subprocess, single_cross_section)
+			write_MG_result(single_subprocess, output_parameters, file_name_suffix, single_cross_section, single_uncertainty)
+	else:
+		write_MG_result(subprocess, output_parameters, file_name_suffix, cross_section, xsection_uncertainty)
+
+	if timer is not None:
+		timer.end_phase()
+	return parameters_MG
+
+# the result of one subprocess at one point, appended to the result shard if there is one, otherwise into its own JSON file.
+# Every line of a shard is written at once, readers skip a last line without newline.
+def write_result(data, file_name_suffix):
+	if result_shard is not None:
+		shard_file = open(result_shard, 'a')
+		shard_file.write(json.dumps(data, sort_keys = True) + '\n')
+		shard_file.close()
+		print 'Data appended to the result shard ', result_shard
+		return
+	JSON_file_name = output_path + data['process'] + '_' + file_name_suffix + JSON_extension
+	write_data_to_JSON(data, JSON_file_name)
+	print 'Data written into JSON file ', JSON_file_name
+
+# JSON output (and result store entry) of one subprocess at one point
+def write_MG_result(subprocess, parameters, file_name_suffix, cross_section, xsection_uncertainty = None):
+	data_to_write = parameters.to_record()
 	data_to_write['xsection'] = cross_section
+	if xsection_uncertainty is not None:
+		data_to_write['xsection_uncertainty'] = xsection_uncertainty
 	data_to_write['process'] = subprocess
-	JSON_file_name = output_path + subprocess + '_' + file_name_suffix + '.txt'
-	write_data_to_JSON(data_to_write, JSON_file_name)
-	print 'Data written into JSON file ', JSON_file_name
+	data_to_write['model_version'] = model_version()
+	data_to_write['MG_version'] = MG_version()
+	# the result written last is used for a point calculated more than once (make_results_table.py)
+	data_to_write['timestamp'] = time()
+	write_result(data_to_write, file_name_suffix)
+
+	if result_store is not None:
+		result_store.put(data_to_write, data_to_write['model_version'], data_to_write['MG_version'])
+
+# timing record of one MadGraph session, written into the logs folder next to the JSON results
+def write_timing_record(timer, subprocess, points, points_suffixes, file_name_suffix, reuse_process = False, nb_core = 0, precision = 0):
+	global timing_path
+	record = timer.timing_record()
+	record['process'] = subprocess
+	record['name'] = subprocess + '_' + file_name_suffix
+	record['points'] = points_suffixes
+	record['mV'] = [parameters.mV for parameters in points]
+	record['a_r'] = [parameters.a_r for parameters in points]
+	record['g'] = [parameters.g for parameters in points]
+	record['BR'] = [parameters.BR for parameters in points]
+	record['number_of_points'] = len(points)
+	record['reuse_process'] = bool(reuse_process)
+	record['nb_core'] = nb_core
+	record['precision'] = precision
+	make_folder_if_not_exists(timing_path)
+	timing_filename = timing_path + subprocess + '_' + file_name_suffix + '.timing.json'
+	write_data_to_JSON(record, timing_filename)
+	print 'Timing record written into ', timing_filename
+
+
+
+# analytic widths mode: deterministic 1 in width_check_every sample of the points (independent of how
+# the points are split into jobs) for which MadGraph still computes the width as a cross-check
+def width_check_sampled(parameters, width_check_every):
+	if width_check_every <= 1:
+		return True
+	return int(hashlib.md5(repr(parameters.key())).hexdigest(), 16) % width_check_every == 0
+
+def width_comparison(points_suffix, parameters, parameters_MG):
+	comparison = {'point' : points_suffix, 'match' : bool(parameters.isclose(parameters_MG))}
+	for field in ['G_tot', 'BR']:
+		comparison[field] = getattr(parameters, field)
+		comparison[field + '_MG'] = getattr(parameters_MG, field)
+		# absolute difference for a vanishing value (BR = 0 for mDM >= mV/2)
+		if comparison[field] == 0:
+			comparison['relative_difference_' + field] = abs(comparison[field + '_MG'])
+		else:
+			comparison['relative_difference_' + field] = abs(comparison[field + '_MG']/comparison[field] - 1)
+	return comparison
+
+# bulk report of the width cross-checks of a MadGraph session, also written into the logs folder
+def report_width_checks(width_checks, subprocess, file_name_suffix, number_of_points):
+	global timing_path
+	mismatches = [comparison for comparison in width_checks if not comparison['match']]
+	print 'Width cross-check: %s of %s points checked against MadGraph, %s mismatching' % (len(width_checks), number_of_points, len(mismatches))
+	for field in ['G_tot', 'BR']:
+		if not width_checks:
+			break
+		print '    max. relative difference of %s: %.2e' % (field, max(comparison['relative_difference_' + field] for comparison in width_checks))
+	for comparison in mismatches:
+		print '    mismatch for %s: G_tot = %s (MG: %s), BR = %s (MG: %s)' % (comparison['point'], comparison['G_tot'], comparison['G_tot_MG'], comparison['BR'], comparison['BR_MG'])
+	make_folder_if_not_exists(timing_path)
+	width_check_filename = timing_path + subprocess + '_' + file_name_suffix + '.width_check.json'
+	write_data_to_JSON({'process' : subprocess, 'number_of_points' : number_of_points, 'width_checks' : width_checks}, width_check_filename)
+	print 'Width cross-checks written into ', width_check_filename
+
+# sets the module-wide paths, also used when running points in-process (e.g. from submit_MG_jobs.py)
+def set_paths(workspace, output, process_cache = 'process_cache', executable = None):
+	global workspace_path, output_path, process_cache_path, madgraph_executable, timing_path
+	workspace_path = workspace + '/'
+	make_folder_if_not_exists(workspace_path)
+	output_path = output + '/'
+	make_folder_if_not_exists(output_path)
+	timing_path = output_path + 'logs/'
+	process_cache_path = process_cache + '/'
+	if executable:
+		madgraph_executable = executable
+
+def set_result_store(filename):
+	global result_store
+	if result_store is not None:
+		result_store.close()
+	result_store = None
+	if filename:
+		result_store = ResultStore(filename)
+
+# shard (in the output path) the results are appended to, one file per point and subprocess if not set
+def set_result_shard(name):
+	global result_shard
+	result_shard = None
+	if name:
+		result_shard = output_path + name
+
+# results of a point already in the result store for the current model and MadGraph versions
+# (one per subprocess of the combined subprocess), None if any is missing
+def stored_results(subprocess, parameters):
+	if result_store is None:
+		return None
+	subprocesses = [subprocess]
+	if subprocess == combined_subprocess:
+		subprocesses = combined_subprocesses
+	results = []
+	for single_subprocess in subprocesses:
+		data = result_store.get(single_subprocess, parameters.mV, parameters.mDM, parameters.a_r, g = parameters.g,
+		                        model_version = model_version(), MG_version = MG_version())
+		if data is None:
+			return None
+		results.append(data)
+	return results
+
+# input point with g, BR or the total width set, returns the point with all parameters calculated,
+# its file name suffix and whether the width is left to MG
+def prepare_point(mV, mDM, a_r, g = '', BR = '', total_width = '', verbose = True):
+	if not g and not total_width and not BR:
+		print 'Insufficient input parameters, please enter the total width (G), branching ratio (BR) or the g coupling constant (g).'
+		sys.exit(1)
+
+	parameters = ParameterSpace()
+
+	parameters.set_mV(mV)
+	parameters.set_mDM(mDM)
+	parameters.set_a_r(a_r)
+
+	auto_width = True
+	if total_width:
+		auto_width = False
+
+	if g:
+		parameters.set_g(g)
+
+	if BR:
+		parameters.set_BR(BR)
+
+	if total_width:
+		parameters.set_G_tot(total_width)
+
+	file_name_suffix = copy.copy(parameters.parameter_space_name())
+	if verbose:
+		print 'Input parameters:'
+		parameters.print_initial_parameters()
+	parameters.calculate_all()
+	if verbose:
+		print '*'*100
+		print 'Analytically calculated parameters:'
+		parameters.print_calculated_parameters()
+
+	return parameters, file_name_suffix, auto_width
+
+# runs MadGraph for a list of points of one subprocess and writes the results,
+# returns the points without MadGraph output and the ones with mismatching parameters.
+# width_check_every > 0: the analytic width is given to MadGraph, which computes it only for 1 in width_check_every points as a cross-check
+def calculate_MG_xsections(subprocess, points, points_suffixes, file_name_suffix, auto_width = True, reuse_process = False, nb_core = 0, precision = 0, width_check_every = 0):
+	timer = Timer()
+	timer_value = timer.elapsed_time()
+
+	# points already computed are only copied from the result store into the JSON output
+	points_to_run = []
+	points_suffixes_to_run = []
+	for parameters, points_suffix in zip(points, points_suffixes):
+		results = stored_results(subprocess, parameters)
+		if results:
+			for data in results:
+				write_result(data, points_suffix)
+			print 'Result for parameter set %s taken from the result store %s' % (points_suffix, result_store.filename)
+		else:
+			points_to_run.append(parameters)
+			points_suffixes_to_run.append(points_suffix)
+	if not points_to_run:
+		return [], []
+	points = points_to_run
+	points_suffixes = points_suffixes_to_run
+
+	process_directory = None
+	first_MG_phase = 'MG_output'
+	if reuse_process:
+		timer.start_phase('process_cache')
+		process_directory = get_cached_process_directory(subprocess, timer)
+		first_MG_phase = 'MG_launch'
+
+	print '.'*100
+
+	print 'Creating the new MadGraph config for %s process.' % subprocess
+	timer.start_phase('config')
+	if width_check_every:
+		auto_widths = [width_check_sampled(parameters, width_check_every) for parameters in points]
+	else:
+		auto_widths = [auto_width]*len(points)
+	create_MG_batch_config(subprocess, points, points_suffixes, file_name_suffix, auto_widths, process_directory, nb_core, precision)
 
-	return parameters_MG
+	run_MG_config(subprocess, points[0], file_name_suffix, auto_width, timer, first_MG_phase)
+	print 'Runtime for process %s, parameter set %s : %.1f min' % (subprocess, file_name_suffix, (timer.elapsed_time()-timer_value)/60)
 
+	timer_value = timer.elapsed_time()
 
+	uncertainties = read_MG_uncertainties(subprocess, file_name_suffix)
 
-if __name__ == '__main__':
-    timer = Timer()
-    timer_value = timer.elapsed_time()
+	mismatched_points = []
+	missing_points = []
+	width_checks = []
+	for parameters, points_suffix, point_auto_width, (MG_directory, run_name) in zip(points, points_suffixes, auto_widths, MG_runs(subprocess, points_suffixes, file_name_suffix, process_directory)):
+		if not os.path.isfile(MG_banner_filename(MG_directory, run_name)):
+			print 'Warning: no MadGraph output for parameter set %s (%s)' % (points_suffix, MG_banner_filename(MG_directory, run_name))
+			missing_points.append(points_suffix)
+			continue
+
+		parameters_copy = copy.copy(parameters)
+
+		MG_calculated_parameters = read_MG_output(subprocess, parameters, points_suffix, point_auto_width, process_directory=MG_directory, run_name=run_name, timer=timer, xsection_uncertainty=uncertainties.get(run_name))
+
+		if width_check_every:
+			# only the sampled points have a MadGraph calculated width to compare with
+			if point_auto_width:
+				width_checks.append(width_comparison(points_suffix, parameters_copy, MG_calculated_parameters))
+				if not width_checks[-1]['match']:
+					mismatched_points.append(points_suffix)
+			continue
 
+		if not parameters_copy.isclose(MG_calculated_parameters):
+			print 'Warning: analytically calculated parameters do not exactly match with MadGraph calculated ones.'
+			print 'Analytical parameters: ', parameters_copy
+			print 'MG-calculated parameters: ', MG_calculated_parameters
+			mismatched_points.append(points_suffix)
+
+	if len(points) > 1:
+		print 'Processed %s points: %s without MadGraph output, %s with mismatching parameters.' % (len(points), len(missing_points), len(mismatched_points))
+
+	if width_check_every:
+		report_width_checks(width_checks, subprocess, file_name_suffix, len(points))
+
+	write_timing_record(timer, subprocess, points, points_suffixes, file_name_suffix, reuse_process, nb_core, precision)
+
+	return missing_points, mismatched_points
+
+
+if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option( "-o", "--output_path", dest = "output_path", default = 'output_JSON',
                   help = "Set the output path where all the JSON files with results are stored (default: output_JSON)" )
@@ -196,65 +825,57 @@ if __name__ == '__main__':
     parser.add_option( "-B", "--BR", dest = "BR", default = '',
                       help = "Set the invisible BR (default - automatic)" )
     parser.add_option( "-s", "--signal", dest = "signal", default = 'tt_exclusive',
-                  help = "Choose the signal of interest. Default: tt_exclusive (prompt tt production), alternatively ttu_offshellV, ttu_onshellV, monotop" )
+                  help = "Choose the signal of interest. Default: tt_exclusive (prompt tt production), alternatively ttu_offshellV, ttu_onshellV, monotop, or all (all of them in one MadGraph run)" )
+    parser.add_option( "-c", "--reuse_process", action = "store_true", dest = "reuse_process",
+                      help = "Generate/compile the MadEvent process directory once and only update the param_card for each point" )
+    parser.add_option( "-C", "--process_cache_path", dest = "process_cache_path", default = 'process_cache',
+                  help = "Set the path where the compiled MadEvent process directories are cached (default: process_cache)" )
+    parser.add_option( "-p", "--points", dest = "points", default = '',
+                  help = "Run many points in one MadGraph session: CSV table, JSON list of points or JSON grid specification (overrides -M/-a/-g/-B/-G)" )
+    parser.add_option( "-n", "--nb_core", dest = "nb_core", default = 0,
+                  help = "Set the number of cores used by a MadGraph run (default: MadGraph configuration)" )
+    parser.add_option( "-S", "--result_store", dest = "result_store", default = '',
+                  help = "Set the result store (SQLite file): points already in it are not recalculated, new results are added" )
+    parser.add_option( "-x", "--xsection_only", action = "store_true", dest = "xsection_only",
+                      help = "Fast mode: only integrate the cross-section (minimal number of events, no systematics) to the precision set by -P" )
+    parser.add_option( "-P", "--precision", dest = "precision", default = 0.01,
+                  help = "Set the relative precision of the integration in the cross-section only mode (default: 0.01)" )
+    parser.add_option( "-W", "--analytic_width", action = "store_true", dest = "analytic_width",
+                      help = "Give the analytically calculated width to MadGraph instead of WV Auto, MadGraph computes it only for a sample of points (-K) as a cross-check" )
+    parser.add_option( "-K", "--width_check_every", dest = "width_check_every", default = 50,
+                  help = "With -W, cross-check the width with MadGraph for 1 in this many points (default: 50)" )
+    parser.add_option( "-J", "--result_shard", dest = "result_shard", default = '',
+                  help = "Append the results as JSON lines to this shard in the output path (e.g. results.jsonl) instead of writing one JSON file per point and subprocess" )
+    parser.add_option( "-e", "--MG_executable", dest = "MG_executable", default = madgraph_executable,
+                  help = "Set the MadGraph executable (default: %s)" % madgraph_executable )
 
     ( options, args ) = parser.parse_args()
 
-    workspace_path = options.workspace_path + '/'
-    make_folder_if_not_exists(workspace_path)
-
-    output_path = options.output_path + '/'
-    make_folder_if_not_exists(output_path)
+    set_paths(options.workspace_path, options.output_path, options.process_cache_path, options.MG_executable)
+    set_result_store(options.result_store)
+    set_result_shard(options.result_shard)
 
     current_process = options.signal
 
-    if not options.g and not options.total_width and not options.BR:
-        print 'Insufficient input parameters, please enter the total width (G), branching ratio (BR) or the g coupling constant (g).'
-        sys.exit(1)
-
-    parameters = ParameterSpace()
-
-    parameters.set_mV(options.mV)
-    parameters.set_mDM(options.mDM)
-    parameters.set_a_r(options.a_r)
-
-    auto_width = True
-    if options.total_width:
-    	auto_width = False
-
-    if options.g:
-    	parameters.set_g(options.g)
-
-    if options.BR:
-    	parameters.set_BR(options.BR)
-
-    if options.total_width:
-        parameters.set_G_tot(options.total_width)
-
-    file_name_suffix = copy.copy(parameters.parameter_space_name())
-    print 'Input parameters:'
-    parameters.print_initial_parameters()
-    parameters.calculate_all()
-    print '*'*100
-    print 'Analytically calculated parameters:'
-    parameters.print_calculated_parameters()
+    if options.points:
+        points, points_suffixes, auto_width = read_points(options.points, options.mDM)
+        file_name_suffix = 'batch_' + os.path.splitext(os.path.basename(options.points))[0]
+        print 'Read %s points from %s' % (len(points), options.points)
+    else:
+        parameters, file_name_suffix, auto_width = prepare_point(options.mV, options.mDM, options.a_r, options.g, options.BR, options.total_width)
+        points = [parameters]
+        points_suffixes = [file_name_suffix]
 
-    print '.'*100
+    precision = 0
+    if options.xsection_only:
+        precision = float(options.precision)
 
-    print 'Creating the new MadGraph config for %s process.' % current_process
-    create_MG_config(current_process, parameters, file_name_suffix, auto_width)
-    
-    run_MG_config(current_process, parameters, file_name_suffix, auto_width)
-    print 'Runtime for process %s, parameter set %s : %.1f min' % (current_process, file_name_suffix, (timer.elapsed_time()-timer_value)/60)
-    
-    timer_value = timer.elapsed_time()
+    width_check_every = 0
+    if options.analytic_width:
+        width_check_every = int(options.width_check_every)
 
-    parameters_copy = copy.copy(parameters)
-    
-    MG_calculated_parameters = read_MG_output(current_process, parameters, file_name_suffix, auto_width)
+    missing_points, mismatched_points = calculate_MG_xsections(current_process, points, points_suffixes, file_name_suffix, auto_width, options.reuse_process, int(options.nb_core), precision, width_check_every)
 
-    if parameters_copy!=MG_calculated_parameters:
-    	print 'Warning: analytically calculated parameters do not exactly match with MadGraph calculated ones.'
-    	print 'Analytical parameters: ', parameters_copy.__dict__
-    	print 'MG-calculated parameters: ', MG_calculated_parameters.__dict__
-    	sys.exit(1)
+    # with analytic widths the mismatches of the cross-check are reported in bulk (see summarise_timing.py -W)
+    if missing_points or (mismatched_points and not options.analytic_width):
+        sys.exit(1)
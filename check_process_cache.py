@@ -0,0 +1,133 @@
+# this script checks the cached MadEvent process directories (calculate_MG_xsection.py -c) without MadGraph, using
+# mg5_aMC_stub.py as the MadGraph executable: several sessions run the same points over the same cache in a temporary
+# MadGraph directory (with a dummy model), and after every session the cross-sections of all points are compared with
+# the ones the stub calculated in this session (scaled by MG_STUB_SCALE, so that results of an earlier session are noticed)
+
+import os, sys
+import glob
+import json
+import shutil
+import tempfile
+import subprocess as sp
+from optparse import OptionParser
+
+package_path = os.path.dirname(os.path.abspath(__file__))
+stub_executable = os.path.join(package_path, 'mg5_aMC_stub.py')
+
+# the a_r values 0.055 and 0.06 give the same point name with 2 digits
+points = [
+    {'mV' : 1000, 'a_r' : 0.1, 'g' : 0.5},
+    {'mV' : 1000, 'a_r' : 0.055, 'g' : 0.5},
+    {'mV' : 1000, 'a_r' : 0.06, 'g' : 0.5},
+    {'mV' : 2000, 'a_r' : 0.2, 'g' : 1.0},
+]
+
+combined_subprocesses = ['tt_exclusive', 'onshellV', 'offshellV', 'monotop']
+
+# sessions as (description, process, extra options, scale of the stub cross-sections)
+sessions = [
+    ('first session', 'monotop', [], 1),
+    ('second session over the cached process', 'monotop', [], 2),
+    ('cross-section only session', 'monotop', ['-x', '-P', '0.05'], 3),
+    ('full session after the cross-section only one', 'monotop', [], 4),
+    ('combined processes', 'all', [], 5),
+    ('combined processes again', 'all', [], 6),
+]
+
+# the cross-section of the stub, subprocesses of the combined process are the process number tag times it
+def stub_cross_section(point, scale, tag = 1):
+    return point['a_r']**2 * 0.01 * (1000. / point['mV'])**4 * scale * tag
+
+def prepare_MG_directory(MG_path):
+    os.makedirs(MG_path + '/models/MonotopDMF_UFO')
+    with open(MG_path + '/models/MonotopDMF_UFO/particles.py', 'w') as f:
+        f.write('# dummy model for mg5_aMC_stub.py\n')
+    with open(MG_path + '/VERSION', 'w') as f:
+        f.write('version = stub\n')
+    with open(MG_path + '/points.json', 'w') as f:
+        json.dump(points, f)
+
+def run_session(MG_path, output_path, process, options, scale):
+    command = [sys.executable, os.path.join(package_path, 'calculate_MG_xsection.py'), '-p', 'points.json', '-c',
+               '-s', process, '-w', 'workspace', '-o', output_path, '-C', 'process_cache', '-e', stub_executable] + options
+    environment = dict(os.environ)
+    environment['MG_STUB_SCALE'] = str(scale)
+    environment['MG_STUB_LOG'] = MG_path + '/stub.log'
+    session = sp.Popen(command, cwd = MG_path, env = environment, stdout = sp.PIPE, stderr = sp.STDOUT)
+    output = session.communicate()[0]
+    if session.returncode != 0:
+        print output
+        print 'calculate_MG_xsection.py failed'
+        sys.exit(1)
+
+# differences of the written results to the expected cross-sections, one line per problem
+def compare_results(output_path, process, scale):
+    results = {}
+    for filename in glob.glob(output_path + '/*.txt'):
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        key = (data['process'], round(data['mV']), round(data['a_r'], 6))
+        results[key] = data['xsection']
+
+    problems = []
+    if process == 'all':
+        tagged_subprocesses = [(subprocess, tag+1) for tag, subprocess in enumerate(combined_subprocesses)]
+    else:
+        tagged_subprocesses = [(process, 1)]
+    for point in points:
+        for subprocess, tag in tagged_subprocesses:
+            key = (subprocess, round(point['mV']), round(point['a_r'], 6))
+            expected = stub_cross_section(point, scale, tag)
+            if not key in results:
+                problems.append('no result for %s' % (key,))
+            elif abs(results[key] - expected) > 1e-6 * expected:
+                problems.append('%s: cross-section %s instead of %s' % (key, results[key], expected))
+    if len(results) != len(points) * len(tagged_subprocesses):
+        problems.append('%s results for %s points' % (len(results), len(points) * len(tagged_subprocesses)))
+    return problems
+
+def run_card_value(MG_path, process, key):
+    for run_card_filename in glob.glob(MG_path + '/process_cache/%s_*/Cards/run_card.dat' % process):
+        for line in open(run_card_filename, 'r').readlines():
+            columns = line.split()
+            if len(columns) >= 3 and columns[2] == key:
+                return columns[0]
+    return None
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option( "-k", "--keep", action = "store_true", dest = "keep",
+                  help = "Keep the temporary MadGraph directory with the process cache and the results" )
+
+    ( options, args ) = parser.parse_args()
+
+    MG_path = tempfile.mkdtemp(prefix = 'check_process_cache_')
+    prepare_MG_directory(MG_path)
+
+    failures = 0
+    for session, (description, process, session_options, scale) in enumerate(sessions):
+        output_path = 'output_JSON_%d' % session
+        run_session(MG_path, output_path, process, session_options, scale)
+        problems = compare_results(MG_path + '/' + output_path, process, scale)
+        if session_options == [] and run_card_value(MG_path, process, 'nevents') != '10000':
+            problems.append('run_card of the cached process has nevents = %s' % run_card_value(MG_path, process, 'nevents'))
+        if problems:
+            failures += 1
+        print '%-50s %s' % (description + ':', 'results of this session' if not problems else 'WRONG RESULTS')
+        for problem in problems:
+            print '    ' + problem
+
+    # the process directory is generated once per process
+    generated = len(open(MG_path + '/stub.log', 'r').readlines())
+    if generated != 2:
+        failures += 1
+        print 'The process directories were generated %s times instead of 2.' % generated
+
+    if options.keep:
+        print 'MadGraph directory with the process cache kept in', MG_path
+    else:
+        shutil.rmtree(MG_path)
+    if failures:
+        print 'The cached process directories gave wrong results in %s checks.' % failures
+        sys.exit(1)
+    print 'Every session over the cached process directories gave the results of the session.'
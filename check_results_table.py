@@ -0,0 +1,94 @@
+# this script checks that the incremental update of the results table (make_results_table.py -u) gives the same table
+# as a full rebuild: synthetic results are added step by step (new shards, lines appended to shards, JSON files rewritten,
+# the same points in several inputs) to a temporary output directory, and after every step both tables are made and compared
+
+import os, sys
+import json
+import shutil
+import tempfile
+import subprocess as sp
+from optparse import OptionParser
+
+processes = ['tt_exclusive', 'onshellV', 'offshellV', 'monotop']
+
+# results are written with the time of the step, as calculate_MG_xsection.py writes them with the current time
+step_time = 1000000000
+
+def result(process, mV, a_r, g, xsection, G_tot = 10.0):
+    return {'process' : process, 'mV' : mV, 'mDM' : 1.0, 'a_r' : a_r, 'g' : g, 'BR' : 0.5, 'G_tot' : G_tot, 'xsection' : xsection,
+            'timestamp' : step_time}
+
+def append_to_shard(filename, results):
+    with open(filename, 'a') as f:
+        for data in results:
+            f.write(json.dumps(data) + '\n')
+
+def write_JSON_file(filename, data):
+    with open(filename, 'w') as f:
+        json.dump(data, f)
+
+# steps of the scan: each one changes the inputs, the times are set explicitly (one step after the other)
+def scan_steps(input_path):
+    point_results = lambda mV, a_r, g, xsection: [result(process, mV, a_r, g, xsection) for process in processes]
+    shard_a = input_path + '/a.jsonl'
+    shard_b = input_path + '/b.jsonl'
+    JSON_file = input_path + '/c_tt_exclusive.txt'
+    return [
+        ('new shard', lambda: append_to_shard(shard_b, point_results(1000, 0.1, 0.5, 1.0) + point_results(1000, 0.2, 0.5, 2.0)), [shard_b]),
+        ('JSON file with a point of the shard', lambda: write_JSON_file(JSON_file, result('tt_exclusive', 1000, 0.1, 0.5, 1.5)), [JSON_file]),
+        ('earlier named shard with the same point', lambda: append_to_shard(shard_a, [result('tt_exclusive', 1000, 0.1, 0.5, 1.7)] + point_results(1500, 0.1, 0.5, 3.0)), [shard_a]),
+        ('later named shard extended', lambda: append_to_shard(shard_b, point_results(1000, 0.2, 0.5, 2.5)), [shard_b]),
+        ('JSON file rewritten', lambda: write_JSON_file(JSON_file, result('tt_exclusive', 1000, 0.2, 0.5, 2.7)), [JSON_file]),
+        ('incomplete point', lambda: append_to_shard(shard_a, [result('monotop', 2000, 0.1, 0.5, 4.0)]), [shard_a]),
+        ('point completed', lambda: append_to_shard(shard_b, point_results(2000, 0.1, 0.5, 4.5)[:3]), [shard_b]),
+        ('one process rerun with another width', lambda: append_to_shard(shard_a, [result('onshellV', 1500, 0.1, 0.5, 3.5, 10.5)]), [shard_a]),
+    ]
+
+def make_table(input_path, output_table, update):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'make_results_table.py'),
+               '-i', input_path, '-o', output_table, '-j', '1']
+    if update:
+        command.append('-u')
+    process = sp.Popen(command, stdout = sp.PIPE, stderr = sp.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        print output
+        print 'make_results_table.py failed'
+        sys.exit(1)
+    with open(output_table, 'r') as f:
+        return f.read()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option( "-k", "--keep", action = "store_true", dest = "keep",
+                  help = "Keep the temporary directory with the inputs and tables" )
+
+    ( options, args ) = parser.parse_args()
+
+    working_path = tempfile.mkdtemp(prefix = 'check_results_table_')
+    input_path = working_path + '/output_JSON'
+    os.mkdir(input_path)
+
+    mismatches = 0
+    for step, (description, change, changed_files) in enumerate(scan_steps(input_path)):
+        step_time = 1000000000 + step
+        change()
+        for filename in changed_files:
+            os.utime(filename, (step_time, step_time))
+        updated_table = make_table(input_path, working_path + '/updated_table.csv', True)
+        full_table = make_table(input_path, working_path + '/full_table.csv', False)
+        same = updated_table == full_table
+        if not same:
+            mismatches += 1
+        print '%-45s %s' % (description + ':', 'same tables' if same else 'DIFFERENT TABLES')
+        if not same:
+            print 'incremental:\n' + updated_table + 'full:\n' + full_table
+
+    if options.keep:
+        print 'Inputs and tables kept in', working_path
+    else:
+        shutil.rmtree(working_path)
+    if mismatches:
+        print 'The incremental and the full tables differ after %s steps.' % mismatches
+        sys.exit(1)
+    print 'The incremental and the full tables are the same after every step.'
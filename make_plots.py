@@ -14,6 +14,8 @@ import scipy.optimize
 import ROOT
 from optparse import OptionParser
 from calculate_MG_xsection import make_folder_if_not_exists
+from ParameterSpace import ParameterGrid
+from ParameterTable import read_table, read_metadata
 from cross_sections_DM import *
 
 import matplotlib.cm as cm
@@ -147,6 +149,19 @@ def get_limit_value(mV, a_r, g = '', BR='', type=1, process='visible', xsection_
     return value
 
 
+# one branch per column of the parameter table, as TTree::ReadFile would make from the CSV table
+def fill_tree_from_table(tree, table):
+    leafValues = dict((name, array.array("d", [0.0])) for name in table.dtype.names)
+    for name in table.dtype.names:
+        tree.Branch(name, leafValues[name], name + "/D")
+
+    for row in table:
+        for name in table.dtype.names:
+            leafValues[name][0] = row[name]
+        tree.Fill()
+
+    return tree.GetEntries()
+
 def load_limits_to_tree(tree, mode="BlindExp", BR_run=False):
     events = tree.GetEntries()
 
@@ -199,7 +214,27 @@ def load_limits_to_tree(tree, mode="BlindExp", BR_run=False):
 
     return new_tree
 
-def get_narrow_width_approx_area(tree, variables='mV:a_r', nwa_limit=0.1, interpolate=True):
+def get_exact_narrow_width_border(tree, x_variable_name, y_variable_name, x_values, nwa_limit=0.1):
+    # parameters not shown on the x axis are fixed by the selection, take them from the first entry
+    for event in tree:
+        point = dict((name, getattr(event, name)) for name in ['mV', 'mDM', 'g', 'BR'])
+        break
+    point[x_variable_name] = np.asarray(x_values)
+
+    if y_variable_name == 'G_tot':
+        return list(nwa_limit * point['mV'] * np.ones(len(x_values)))
+
+    G_tot = nwa_limit * np.asarray(point['mV'])
+    if x_variable_name == 'BR':
+        grid = ParameterGrid.solve_a_r(point['mV'], point['mDM'], BR=point['BR'], G_tot=G_tot)
+    else:
+        grid = ParameterGrid.solve_a_r(point['mV'], point['mDM'], g=point['g'], G_tot=G_tot)
+
+    # no solution: the invisible width alone is above the limit, so the whole column is outside the nwa
+    return list(np.where(grid.unphysical, 0, grid.a_r))
+
+
+def get_narrow_width_approx_area(tree, variables='mV:a_r', nwa_limit=0.1, interpolate=True, exact=True):
     x_variable_name, y_variable_name = variables.split(":")
 
     x_array = []
@@ -215,6 +250,10 @@ def get_narrow_width_approx_area(tree, variables='mV:a_r', nwa_limit=0.1, interp
     x_array = sorted(np.unique(x_array))
     y_array = sorted(np.unique(y_array))
 
+    # solve the width relation analytically instead of interpolating between the scanned points
+    if exact and y_variable_name in ['a_r', 'G_tot']:
+        return get_exact_narrow_width_border(tree, x_variable_name, y_variable_name, x_array, nwa_limit)
+
     roots = []
 
     for x_value in x_array:
@@ -403,19 +442,19 @@ def make_fraction_plots(mV, my_data, mode='visible'):
     global output_folder, log_scale
 
     # sort by G_tot
-    my_data = my_data[my_data[:, 1].argsort()]
+    my_data = my_data[my_data['G_tot'].argsort()]
 
     if mode == 'visible':
         # slice in columns
-        BR = my_data[:, 0]
-        G_tot = my_data[:, 1]
-        a_r = my_data[:, 2]
+        BR = my_data['BR']
+        G_tot = my_data['G_tot']
+        a_r = my_data['a_r']
 
         # cross-sections
-        xsection_tt_excl = my_data[:, 9]
-        xsection_onshell = my_data[:, 8]
-        xsection_offshell = my_data[:, 7]
-        xsection_monotop = my_data[:, 6]
+        xsection_tt_excl = my_data['xsection_tt_exclusive']
+        xsection_onshell = my_data['xsection_onshellV']
+        xsection_offshell = my_data['xsection_offshellV']
+        xsection_monotop = my_data['xsection_monotop']
         xsection_visible = xsection_tt_excl + xsection_onshell + xsection_offshell
         xsection_total = xsection_visible + xsection_monotop
 
@@ -471,18 +510,18 @@ def make_fraction_plots(mV, my_data, mode='visible'):
 
         # only consider g_DM = 1
         g_DM = 1
-        my_data = my_data[my_data[:, 3] == g_DM]
+        my_data = my_data[my_data['g'] == g_DM]
 
         # slice in columns
-        BR = my_data[:, 0]
-        G_tot = my_data[:, 1]
-        a_r = my_data[:, 2]
+        BR = my_data['BR']
+        G_tot = my_data['G_tot']
+        a_r = my_data['a_r']
 
         # cross-sections
-        xsection_tt_excl = my_data[:, 9]
-        xsection_onshell = my_data[:, 8]
-        xsection_offshell = my_data[:, 7]
-        xsection_monotop = my_data[:, 6]
+        xsection_tt_excl = my_data['xsection_tt_exclusive']
+        xsection_onshell = my_data['xsection_onshellV']
+        xsection_offshell = my_data['xsection_offshellV']
+        xsection_monotop = my_data['xsection_monotop']
         xsection_visible = xsection_tt_excl + xsection_onshell + xsection_offshell
         xsection_total = xsection_visible + xsection_monotop
 
@@ -753,23 +792,23 @@ def make_2D_plots(mV, my_data, process, with_limits=False, show_only_mu=False, s
         sys.exit(1)
 
     # slice in columns
-    BR = my_data[:, 0]
-    G_tot = my_data[:, 1]
-    a_r = my_data[:, 2]
-    g = my_data[:, 3]
+    BR = my_data['BR']
+    G_tot = my_data['G_tot']
+    a_r = my_data['a_r']
+    g = my_data['g']
     if 'tt_excl' in process:
-        xsection = my_data[:, 9]
+        xsection = my_data['xsection_tt_exclusive']
         MC_cross_section = cross_sections_tt_excl[str(mV)]
     elif 'onshell' in process:
-        xsection = my_data[:, 8]
+        xsection = my_data['xsection_onshellV']
         MC_cross_section = cross_sections_onshellV[str(mV)]
     elif 'offshell' in process:
-        xsection = my_data[:, 7]
+        xsection = my_data['xsection_offshellV']
         MC_cross_section = cross_sections_offshellV[str(mV)]
     elif 'monotop' in process:
-        xsection = my_data[:, 6]
+        xsection = my_data['xsection_monotop']
     elif 'visible' in process:
-        xsection = my_data[:, 9] + my_data[:, 8] + my_data[:, 7]
+        xsection = my_data['xsection_tt_exclusive'] + my_data['xsection_onshellV'] + my_data['xsection_offshellV']
         if with_limits:
             limits = np.asarray([get_limit_value(mV, a_r_value, g_value) for a_r_value, g_value in zip(a_r, g)])
             xsection = xsection * limits
@@ -981,6 +1020,15 @@ if __name__ == '__main__':
     # file path to the parameters table, based on the parameterisation name
     parameter_table = 'parameter_tables/table_' + parameterisation + '.csv'
 
+    # masses and parameterisation of the scan from the description of the table, if it has one
+    scan = None
+    metadata = read_metadata(parameter_table)
+    if metadata is not None:
+        scan = metadata['scan']
+    if scan is not None:
+        mediator_masses = [int(mV) for mV in scan['mV']]
+        BR_run = scan['scanned_parameter'] == 'BR'
+
     # fix for automatically excluded limit folder names
     # the parameter table has values up to a_r=0.3, whereas visible limit files - up to 0.15 (since a_r>0.15 are all excluded for visible process)
     input_folder = input_folder.replace('a_r_0.3', 'a_r_0.15')
@@ -999,13 +1047,12 @@ if __name__ == '__main__':
     if log_scale:
         output_folder += '/log/'
 
-    whole_data = np.genfromtxt(parameter_table, delimiter=',')
-    # delete first row (variable names)
-    whole_data = np.delete(whole_data, (0), axis=0)
+    # binary copy of the table (memory-mapped) if there is one
+    whole_data = read_table(parameter_table)
 
     temp_root_file = ROOT.TFile("tree.root", "recreate")
-    tree = ROOT.TTree("ntuple", "data from csv table")
-    nlines = tree.ReadFile(parameter_table,'BR/D:G_tot/D:a_r/D:g/D:mDM/D:mV/D:xsection_monotop/D:xsection_offshellV/D:xsection_onshellV/D:xsection_tt_exclusive/D',',')
+    tree = ROOT.TTree("ntuple", "data from parameter table")
+    nlines = fill_tree_from_table(tree, whole_data)
     print "found %s points" % (nlines)
     tree = load_limits_to_tree(tree, mode, BR_run=BR_run)
     temp_root_file.Write()
@@ -1016,7 +1063,7 @@ if __name__ == '__main__':
 
     if options.fraction_plots:
         for mV in mediator_masses:
-            single_mV_data = whole_data[whole_data[:, 5] == mV]
+            single_mV_data = whole_data[whole_data['mV'] == mV]
             make_fraction_plots(mV, single_mV_data, mode='visible')
             make_fraction_plots(mV, single_mV_data, mode='total')
     elif 'nominal' in parameterisation:
@@ -1025,6 +1072,8 @@ if __name__ == '__main__':
         if 'fine' in parameterisation:
             # don't have 1.5 in 'fine' parameterisation yet
             g_DMs = [0.1, 0.5, 1.0]
+        if scan is not None and 'g' in scan:
+            g_DMs = scan['g']
 
         for g_DM in g_DMs:
             make_2D_limit_plot_from_tree(rootpy_tree, variables='mV:a_r', select_gDM=g_DM, mode=mode, process='visible')
@@ -1039,7 +1088,7 @@ if __name__ == '__main__':
     # work with a single mV:
     if options.more_plots:
         for mV in mediator_masses:
-            single_mV_data = whole_data[whole_data[:, 5] == mV]
+            single_mV_data = whole_data[whole_data['mV'] == mV]
             for process in processes:
                 make_all_plots(mV, single_mV_data, process)
     
@@ -1,69 +1,269 @@
-import sys
-import json, csv
+import os, sys
+import json
+import multiprocessing
+import numpy as np
+import calculate_MG_xsection
+from functools import partial
 from optparse import OptionParser
-from os import listdir
-from os.path import isfile, join
+from os.path import isdir, isfile
+from ResultStore import ResultStore, point_fields, result_files, read_result_file, shard_extension
+from ParameterSpace import quantise
+from ParameterTable import make_table, table_columns, scan_definition, write_table, binary_filename
 
-def read_data_from_JSON(JSON_input_file):
-    input_file = open(JSON_input_file, 'r')
-    input_JSON = ''.join(input_file.readlines())
-    data = json.loads(input_JSON)
-    input_file.close()
-    return data
+# canonical key of a point: mV, mDM, a_r and the scanned coupling (g or BR), quantised as in the result store
+def point_key(data, scanned_parameter = 'g'):
+    return tuple(quantise(data[field]) for field in ['mV', 'mDM', 'a_r', scanned_parameter])
+
+# (process, point key, point parameters, cross-section, time the result was written) of a result,
+# the modification time of its input for results without the time
+def result_row(data, scanned_parameter = 'g', mtime = 0.):
+    return data['process'], point_key(data, scanned_parameter), [data[field] for field in point_fields], data['xsection'], data.get('timestamp', mtime)
+
+# rows of all valid results of a file (from the byte offset on for a shard), the number of corrupt ones
+# and the offset up to which the file has been read, run in the worker processes
+def parse_result_file(input_file, scanned_parameter = 'g'):
+    filename, offset, mtime = input_file
+    results, corrupt, offset = read_result_file(filename, offset)
+    return [result_row(data, scanned_parameter, mtime) for data in results], corrupt, offset
+
+# hash join of the results of all processes on the point key. Of several results of a process for a point the one written
+# last is kept (the last one read for the same time), in the full and in the incremental (-u) build.
+# The parameters of a point are the ones of its result written last. Returns the processes, the parameters and their time,
+# the cross-sections and the times of the results by process of every point, and the duplicates per process.
+def merge_results(rows):
+    processes = set()
+    parameters = {}
+    parameter_times = {}
+    xsections = {}
+    times = {}
+    duplicates = {}
+    for process, key, point, xsection, time in rows:
+        processes.add(process)
+        point_xsections = xsections.setdefault(key, {})
+        point_times = times.setdefault(key, {})
+        if process in point_xsections:
+            duplicates[process] = duplicates.get(process, 0) + 1
+            if time < point_times[process]:
+                continue
+        point_xsections[process] = xsection
+        point_times[process] = time
+        if time >= parameter_times.get(key, time):
+            parameters[key] = point
+            parameter_times[key] = time
+    return sorted(processes), parameters, parameter_times, xsections, times, duplicates
+
+# model and MadGraph versions of the results of the store used for the table: the ones given, the ones of the MadGraph
+# directory, or the only ones in the store
+def store_versions(result_store, MG_path = '.', model_version = None, MG_version = None):
+    if model_version is None and os.path.isdir(MG_path + '/' + calculate_MG_xsection.model_path):
+        model_version = calculate_MG_xsection.model_version(MG_path)
+    if MG_version is None and os.path.isfile(MG_path + '/VERSION'):
+        MG_version = calculate_MG_xsection.MG_version(MG_path)
+    versions = [(stored_model_version, stored_MG_version) for stored_model_version, stored_MG_version, count in result_store.versions()
+                if model_version in [None, stored_model_version] and MG_version in [None, stored_MG_version]]
+    if len(versions) == 1:
+        return versions[0]
+    if not versions:
+        print 'No results of model version %s and MadGraph version %s in the result store %s' % (model_version, MG_version, result_store.filename)
+    else:
+        print 'The result store %s has results of several versions, please choose one (-M, --model_version, --MG_version):' % result_store.filename
+    for stored_model_version, stored_MG_version, count in result_store.versions():
+        print '    model version %s, MadGraph version %s: %s results' % (stored_model_version, stored_MG_version, count)
+    sys.exit(1)
+
+# the state of a table is kept next to it, to update it incrementally: the input files already read (size, modification
+# time and, for the shards, the read offset) and all points read so far with their keys, also the ones still missing processes
+def state_filenames(output_table):
+    base = os.path.splitext(output_table)[0]
+    return base + '.inputs.json', base + '.points.npy'
+
+def key_fields(scanned_parameter = 'g'):
+    return ['key_' + field for field in ['mV', 'mDM', 'a_r', scanned_parameter]]
+
+def load_state(output_table, description):
+    inputs_filename, points_filename = state_filenames(output_table)
+    if not isfile(inputs_filename) or not isfile(points_filename):
+        print 'No state of the table %s, reading all inputs' % output_table
+        return {}, None
+    state = json.load(open(inputs_filename, 'r'))
+    if state['description'] != description:
+        print 'The table %s was made from other inputs or with other options, reading all inputs' % output_table
+        return {}, None
+    return state['inputs'], np.load(points_filename)
+
+def save_state(output_table, description, inputs, points):
+    inputs_filename, points_filename = state_filenames(output_table)
+    with open(points_filename + '.tmp', 'wb') as f:
+        np.save(f, points)
+    os.rename(points_filename + '.tmp', points_filename)
+    with open(inputs_filename + '.tmp', 'w') as f:
+        json.dump({'description' : description, 'inputs' : inputs}, f)
+    os.rename(inputs_filename + '.tmp', inputs_filename)
+
+# input files with new results as (filename, offset to read from, modification time), ordered by modification time,
+# and the state of all input files: unchanged files are skipped, and the shards are read on from their last offset
+# as they are only ever extended
+def changed_inputs(list_of_files, inputs):
+    to_read = []
+    current_inputs = {}
+    for filename in list_of_files:
+        stat = os.stat(filename)
+        previous = inputs.get(filename)
+        current_inputs[filename] = {'size' : stat.st_size, 'mtime' : stat.st_mtime, 'offset' : 0}
+        if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime:
+            current_inputs[filename]['offset'] = previous['offset']
+            continue
+        offset = 0
+        if previous and filename.endswith(shard_extension) and stat.st_size >= previous['offset']:
+            offset = previous['offset']
+        to_read.append((filename, offset, stat.st_mtime))
+    return sorted(to_read, key = lambda input_file: (input_file[2], input_file[0])), current_inputs
+
+# merges new rows into the points (sorted by key, cross-sections not available yet are nan): the new result of a process
+# for a point replaces the old one unless the old one was written later (time_<process>)
+def update_points(points, rows, scanned_parameter = 'g'):
+    processes, parameters, parameter_times, xsections, times, duplicates = merge_results(rows)
+    keys = key_fields(scanned_parameter)
+    index = {}
+    if points is not None:
+        processes = sorted(set(processes) | set(name[len('xsection_'):] for name in points.dtype.names if name.startswith('xsection_')))
+        index = dict((key, i) for i, key in enumerate(zip(*[points[field].tolist() for field in keys])))
+    new_keys = sorted(key for key in xsections if not key in index)
+
+    number_of_points = len(index)
+    columns = keys + list(point_fields) + ['xsection_' + process for process in processes] + ['time_' + process for process in processes]
+    updated_points = np.empty(number_of_points + len(new_keys), dtype = [(name, np.float64) for name in columns])
+    for name in columns:
+        updated_points[name] = np.nan
+        if points is not None and name in points.dtype.names:
+            updated_points[name][:number_of_points] = points[name]
+    for i, key in enumerate(new_keys):
+        index[key] = number_of_points + i
+        updated_points[number_of_points + i] = tuple(key) + tuple(parameters[key]) + (np.nan,) * 2 * len(processes)
+    for key, point_xsections in xsections.items():
+        for process, xsection in point_xsections.items():
+            if times[key][process] < updated_points['time_' + process][index[key]]:
+                duplicates[process] = duplicates.get(process, 0) + 1
+                continue
+            updated_points['xsection_' + process][index[key]] = xsection
+            updated_points['time_' + process][index[key]] = times[key][process]
+        # the parameters of the result written last, of the new or the earlier results
+        if index[key] < number_of_points:
+            time_columns = [updated_points['time_' + process][index[key]] for process in processes]
+            if not all(np.isnan(time_columns)) and parameter_times[key] < np.nanmax(time_columns):
+                continue
+        for field, value in zip(point_fields, parameters[key]):
+            updated_points[field][index[key]] = value
+
+    if new_keys:
+        updated_points = updated_points[np.lexsort([updated_points[field] for field in reversed(keys)])]
+    return updated_points, duplicates
 
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option( "-i", "--input_path", dest = "input_path", default = 'output_JSON',
-                  help = "Set the path where all the JSON files with results are stored (default: output_JSON)" )
+                  help = "Set the path where the results (JSON lines shards *.jsonl, or JSON files) are stored (default: output_JSON)" )
+    parser.add_option( "-S", "--result_store", dest = "result_store", default = '',
+                  help = "Set the result store (SQLite file, one per scan): new results from the input path are added to it and the table is made from the store" )
+    parser.add_option( "-M", "--MG_path", dest = "MG_path", default = '.',
+                  help = "Set the MadGraph directory: only the results of its model and MadGraph versions are taken from the result store (default: .)" )
+    parser.add_option( "--model_version", dest = "model_version", default = None,
+                  help = "Take the results of this model version (MD5 of the model files) from the result store" )
+    parser.add_option( "--MG_version", dest = "MG_version", default = None,
+                  help = "Take the results of this MadGraph version from the result store" )
+    parser.add_option( "-B", "--BR_parameters", action = "store_true", dest = "BR_run",
+                  help = "Identify the points by BR instead of g (BR scans)" )
+    parser.add_option( "-o", "--output_table", dest = "output_table", default = 'big_table.csv',
+                  help = "Set the output table, written as CSV and as binary table (.npy) next to it (default: big_table.csv)" )
+    parser.add_option( "-u", "--update", action = "store_true", dest = "update",
+                  help = "Update the table incrementally: only read the new or changed inputs since the table was last made (e.g. every few minutes during a scan)" )
+    parser.add_option( "-j", "--jobs", dest = "jobs", default = multiprocessing.cpu_count(),
+                  help = "Number of processes reading the result files (default: number of cores)" )
 
     ( options, args ) = parser.parse_args()
 
     input_path = options.input_path + '/'
+    scanned_parameter = 'g'
+    if options.BR_run:
+        scanned_parameter = 'BR'
+
+    description = {'input_path' : os.path.abspath(input_path), 'result_store' : options.result_store, 'scanned_parameter' : scanned_parameter}
+    inputs = {}
+    points = None
+    if options.update:
+        inputs, points = load_state(options.output_table, description)
+
+    to_read = []
+    current_inputs = {}
+    # with a result store the results in the input path are optional
+    if isdir(input_path) or not options.result_store:
+        list_of_files = result_files(input_path)
+        to_read, current_inputs = changed_inputs(list_of_files, inputs)
+        print 'Found', len(list_of_files), 'result files in input directory', input_path, '(%s new or changed)' % len(to_read)
 
-    list_of_files = [f for f in listdir(input_path) if isfile(join(input_path, f))]
+    rows = []
+    corrupt = 0
+    if options.result_store:
+        result_store = ResultStore(options.result_store)
+        results = []
+        for filename, offset, mtime in to_read:
+            file_results, file_corrupt, current_inputs[filename]['offset'] = read_result_file(filename, offset)
+            results += file_results
+            corrupt += file_corrupt
+        imported, replaced = result_store.import_results(results)
+        print 'Added %s new results to the result store %s, replaced %s' % (imported, options.result_store, replaced)
+        # the table is made from all results of the store at one model and MadGraph version
+        model_version, MG_version = store_versions(result_store, options.MG_path, options.model_version, options.MG_version)
+        print 'Using the results of model version %s, MadGraph version %s' % (model_version, MG_version)
+        rows = [result_row(data, scanned_parameter) for data in result_store.results(model_version = model_version, MG_version = MG_version)]
+        result_store.close()
+        points = None
+    elif to_read:
+        pool = multiprocessing.Pool(max(1, int(options.jobs)))
+        try:
+            for (filename, offset, mtime), (file_rows, file_corrupt, file_offset) in zip(to_read, pool.imap(partial(parse_result_file, scanned_parameter = scanned_parameter), to_read, chunksize = 16)):
+                rows += file_rows
+                corrupt += file_corrupt
+                current_inputs[filename]['offset'] = file_offset
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    if corrupt:
+        print 'Warning: skipped %s corrupt or incomplete results' % corrupt
 
-    print 'Found', len(list_of_files), 'files in input directory', input_path
+    print 'Read', len(rows), 'results'
+
+    points, duplicates = update_points(points, rows, scanned_parameter)
+    processes = [name[len('xsection_'):] for name in points.dtype.names if name.startswith('xsection_')]
+    if not processes:
+        print 'No results found.'
+        sys.exit(1)
+
+    for process, number_of_duplicates in sorted(duplicates.items()):
+        print 'Warning: %s duplicated points for %s, the results written last are used' % (number_of_duplicates, process)
+
+    complete = np.ones(len(points), dtype = bool)
+    for process in processes:
+        complete &= ~np.isnan(points['xsection_' + process])
+    if not np.all(complete):
+        print 'Warning: %s points without results for all processes are not written:' % np.sum(~complete)
+        for point in points[~complete]:
+            print '    %s = %s: missing %s' % (', '.join(['mV', 'mDM', 'a_r', scanned_parameter]), tuple(point[field] for field in key_fields(scanned_parameter)),
+                                             ', '.join(process for process in processes if np.isnan(point['xsection_' + process])))
 
-    initial_dict = {}
     common_dictionary = {}
+    for field in point_fields:
+        common_dictionary[field] = [round(value, 6) for value in points[field][complete].tolist()]
+    for process in processes:
+        common_dictionary['xsection_' + process] = points['xsection_' + process][complete]
+
+    table = make_table(common_dictionary, table_columns(processes))
+    scan = scan_definition(table, scanned_parameter)
+    scan['input'] = options.result_store or options.input_path
+    write_table(table, options.output_table, scan)
+    save_state(options.output_table, description, current_inputs, points)
 
-    for file in sorted(list_of_files):
-    	dictionary = read_data_from_JSON(input_path + file)
-    	process = dictionary['process']
-    	try:
-    		initial_dict[process]
-    	except:
-    		initial_dict[process] = {}
-    	for key in dictionary.keys():
-    		if not "process" in key and not "m_top" in key:
-    			try:
-    				initial_dict[process][key].append(dictionary[key])
-    			except:
-    				initial_dict[process][key] = []
-    				initial_dict[process][key].append(dictionary[key])
-
-    # initialise the common dictionary
-    for process in initial_dict.keys():
-    	common_dictionary['xsection_' + process] = []
-
-    first_dict_key = next(iter(initial_dict))
-    available_sub_keys = initial_dict[first_dict_key].keys()
-    for key in available_sub_keys:
-        if not "xsection" in key and not "m_top" in key:
-            common_dictionary[key] = []
-
-    number_of_points = len(initial_dict[first_dict_key]['xsection'])
-    for i in range(number_of_points):
-        for key in available_sub_keys:
-            value = initial_dict[first_dict_key][key][i]
-            value = round(value, 6)
-            if not "xsection" in key and not "m_top" in key:
-                common_dictionary[key].append(value)
-        for process in initial_dict.keys():
-            common_dictionary['xsection_' + process].append(initial_dict[process]['xsection'][i])
-
-    keys_to_write = sorted(common_dictionary.keys())
-    with open('big_table.csv', 'wb') as f:
-		writer = csv.writer(f)
-		writer.writerow(keys_to_write)
-		writer.writerows(zip(*[common_dictionary[key] for key in keys_to_write]))
+    print 'Table of %s points written into %s (binary copy: %s)' % (np.sum(complete), options.output_table, binary_filename(options.output_table))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# stand-in for the MadGraph executable (bin/mg5_aMC) to check the scripts without MadGraph, e.g.
+#   python calculate_MG_xsection.py -e /path/to/mg5_aMC_stub.py ...
+# it reads the config written by calculate_MG_xsection.py and mimics what the scripts rely on:
+# - output: a process directory with Cards/run_card.dat (kept between sessions, as the run_card of MadGraph)
+# - launch [-n name]: a banner Events/<run>/<run>_tag_<n>_banner.txt with the parameters, the width (analytic for WV Auto),
+#   the BR, the number of events and a synthetic cross-section (with an <init> block per process number tag @n);
+#   a run name launched again in the same process directory gets the next tag, as in MadEvent
+# - set: run_card settings (nevents, req_acc, use_syst) are written to the run_card, the others only apply to the next launch
+# - print_results --path=<file> --format=short: one line per run and tag of the process directory
+# the cross-section is a_r^2 * 0.01 pb * (1 TeV / mV)^4, times MG_STUB_SCALE if set (to tell the results of two sessions apart),
+# the output commands are logged to MG_STUB_LOG if set (to count the process generations)
+
+import os, sys
+import math
+
+run_card_settings = ['nevents', 'req_acc', 'use_syst', 'nb_core']
+default_run_card = {'nevents' : '10000', 'req_acc' : '-1', 'use_syst' : 'True', 'nb_core' : '0'}
+
+top_mass = 172.
+
+def read_config(filename):
+    lines = []
+    with open(filename, 'r') as f:
+        for line in f.readlines():
+            line = line.split('#')[0].strip()
+            if line:
+                lines.append(line)
+    return lines
+
+# process number tags (@n) of the generated processes
+def process_tags(lines):
+    tags = []
+    for line in lines:
+        if (line.startswith('generate') or line.startswith('add process')) and '@' in line:
+            tags.append(int(line.split('@')[1]))
+    return sorted(tags)
+
+def read_settings(filename):
+    settings = {}
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            for line in f.readlines():
+                columns = line.split()
+                if len(columns) >= 3 and columns[1] == '=':
+                    settings[columns[2]] = columns[0]
+    return settings
+
+def write_settings(filename, settings):
+    with open(filename, 'w') as f:
+        for key in sorted(settings):
+            f.write(' %s = %s\n' % (settings[key], key))
+
+# runs of a process directory in launch order, as (run name, tag, cross-section, uncertainty)
+def read_runs(process_directory):
+    runs = []
+    filename = process_directory + '/HTML/stub_runs.txt'
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            for line in f.readlines():
+                name, tag, cross_section, uncertainty = line.split()
+                runs.append((name, int(tag), float(cross_section), float(uncertainty)))
+    return runs
+
+def add_run(process_directory, run):
+    with open(process_directory + '/HTML/stub_runs.txt', 'a') as f:
+        f.write('%s %d %e %e\n' % run)
+
+def output(process_directory, tags):
+    for directory in ['Cards', 'Events', 'HTML', 'SubProcesses']:
+        if not os.path.isdir(process_directory + '/' + directory):
+            os.makedirs(process_directory + '/' + directory)
+    write_settings(process_directory + '/Cards/run_card.dat', default_run_card)
+    with open(process_directory + '/SubProcesses/tags', 'w') as f:
+        f.write(' '.join(str(tag) for tag in tags))
+    if os.environ.get('MG_STUB_LOG'):
+        with open(os.environ['MG_STUB_LOG'], 'a') as log:
+            log.write('output %s\n' % os.path.abspath(process_directory))
+
+def launch(process_directory, run_name, parameters):
+    runs = read_runs(process_directory)
+    if not run_name:
+        run_name = 'run_%02d' % (len(set(run[0] for run in runs)) + 1)
+    tag = len([run for run in runs if run[0] == run_name]) + 1
+    with open(process_directory + '/SubProcesses/tags', 'r') as f:
+        tags = [int(tag) for tag in f.read().split()]
+    run_card = read_settings(process_directory + '/Cards/run_card.dat')
+
+    mV = parameters.get('MV', 1000.)
+    mDM = parameters.get('Mpsi', 1.)
+    a_r = parameters.get('ar', 0.1)
+    g = parameters.get('gg', 0.5)
+    r_top = top_mass / mV
+    r_DM = mDM / mV
+    G_vis = a_r**2 * mV / math.pi * (1 - r_top**2) * (1 - 0.5 * r_top**2 - 0.5 * r_top**4)
+    G_inv = g**2 * mV / (12 * math.pi) * math.sqrt(1 - 4 * r_DM**2) * (1 + 2 * r_DM**2)
+    if parameters.get('WV', 'Auto') == 'Auto':
+        G_tot = G_vis + G_inv
+    else:
+        G_tot = float(parameters['WV'])
+    cross_section = a_r**2 * 0.01 * (1000. / mV)**4 * float(os.environ.get('MG_STUB_SCALE', 1))
+    tagged_cross_sections = [(tag, cross_section * tag) for tag in tags]
+    if tagged_cross_sections:
+        cross_section = sum(tagged_cross_section for tag, tagged_cross_section in tagged_cross_sections)
+    uncertainty = cross_section * 0.01
+
+    run_directory = process_directory + '/Events/' + run_name
+    if not os.path.isdir(run_directory):
+        os.makedirs(run_directory)
+    with open(run_directory + '/%s_tag_%d_banner.txt' % (run_name, tag), 'w') as banner:
+        banner.write('<MGVersion>\nstub\n</MGVersion>\n')
+        banner.write('      1 %e # ar\n' % a_r)
+        banner.write('      1 %e # gg\n' % g)
+        banner.write('     32 %e # mv\n' % mV)
+        banner.write(' 1000023 %e # mpsi\n' % mDM)
+        banner.write('DECAY  32 %e # wv\n' % G_tot)
+        banner.write('   %e   2    1000023  -1000023 # BR\n' % (G_inv / G_tot))
+        banner.write('#  Number of Events        :       %s\n' % run_card['nevents'])
+        banner.write('#  Integrated weight (pb)  :       %e\n' % cross_section)
+        if tagged_cross_sections:
+            banner.write('<init>\n2212 2212 6.5e3 6.5e3 0 0 247000 247000 -4 %d\n' % len(tagged_cross_sections))
+            for tag_number, tagged_cross_section in tagged_cross_sections:
+                banner.write('%e %e %e %d\n' % (tagged_cross_section, tagged_cross_section * 0.01, tagged_cross_section * 2, tag_number))
+            banner.write('</init>\n')
+    add_run(process_directory, (run_name, tag, cross_section, uncertainty))
+    print 'INFO: %s tag_%d: cross-section %e +- %e pb' % (run_name, tag, cross_section, uncertainty)
+
+def print_results(process_directory, filename):
+    with open(filename, 'w') as f:
+        f.write('# run_name tag cross error Nb_event cross_after_matching nb_event_after matching\n')
+        for run_name, tag, cross_section, uncertainty in read_runs(process_directory):
+            f.write('%s tag_%d %e %e 100 0 0\n' % (run_name, tag, cross_section, uncertainty))
+
+if __name__ == '__main__':
+    lines = read_config(sys.argv[1])
+    tags = process_tags(lines)
+
+    process_directory = None
+    run_name = None
+    parameters = None
+    for line in lines + ['launch -i']:
+        words = line.split()
+        if words[0] == 'launch' or words[0] == 'print_results':
+            # the settings of a launch block end at the next command of the session
+            if parameters is not None:
+                launch(process_directory, run_name, parameters)
+                parameters = None
+        if words[0] == 'output':
+            process_directory = words[1]
+            output(process_directory, tags)
+        elif words[0] == 'launch' and '-i' not in words:
+            process_directory = words[1]
+            run_name = words[words.index('-n') + 1] if '-n' in words else None
+            parameters = {}
+        elif words[0] == 'print_results':
+            print_results(process_directory, words[1].split('=')[1])
+        elif words[0] == 'set' and parameters is not None and len(words) >= 3:
+            if words[1] in run_card_settings:
+                run_card = read_settings(process_directory + '/Cards/run_card.dat')
+                run_card[words[1]] = words[2]
+                write_settings(process_directory + '/Cards/run_card.dat', run_card)
+            else:
+                try:
+                    parameters[words[1]] = float(words[2])
+                except ValueError:
+                    parameters[words[1]] = words[2]
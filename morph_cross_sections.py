@@ -0,0 +1,157 @@
+# this script predicts the subprocess cross-sections for a whole parameter grid from a small set of MadGraph points
+# At fixed mV (and mDM) each cross-section factorises into a power of a_r, a BR factor and a slowly varying function of
+# the relative width w = G_tot/mV, which is fitted with a low-order polynomial in u = w/(1+w) (bounded for very wide V):
+#   tt_exclusive, offshellV : a_r^4 * P(u)
+#   onshellV                : a_r^2 * (1-BR) * P(u)
+#   monotop                 : a_r^2 * BR * P(u)
+
+import sys, os
+import json
+import numpy as np
+from optparse import OptionParser
+from ParameterSpace import ParameterGrid
+from ParameterTable import make_table, table_columns, scan_definition, read_table, write_table
+
+processes = ['tt_exclusive', 'onshellV', 'offshellV', 'monotop']
+
+# coupling and BR dependence of a subprocess cross-section
+def coupling_factor(process, a_r, BR):
+    if 'tt_excl' in process or 'offshell' in process:
+        return a_r**4
+    elif 'onshell' in process:
+        return a_r**2 * (1-BR)
+    elif 'monotop' in process:
+        return a_r**2 * BR
+    else:
+        print 'Unknown process: ', process
+        sys.exit(1)
+
+# basis functions: coupling factor times powers of the (compactified) relative width
+def morphing_basis(process, a_r, BR, relative_width, degree = 2):
+    factor = coupling_factor(process, a_r, BR)
+    u = relative_width/(1+relative_width)
+    return np.column_stack([factor * u**k for k in range(degree+1)])
+
+# fitted coefficients for every (mV, mDM) of the training table
+def fit_morphing(data, process, degree = 2):
+    coefficients = {}
+    for mV, mDM in sorted(set(zip(data['mV'], data['mDM']))):
+        selection = (data['mV'] == mV) & (data['mDM'] == mDM)
+        points = data[selection]
+        if len(points) < degree+1:
+            print 'Warning: only %s training points for mV = %s, mDM = %s, need at least %s' % (len(points), mV, mDM, degree+1)
+            continue
+        xsection = points['xsection_' + process]
+        basis = morphing_basis(process, points['a_r'], points['BR'], points['G_tot']/points['mV'], degree)
+        # relative residuals, as the cross-sections span orders of magnitude
+        coefficients[(mV, mDM)] = np.linalg.lstsq(basis / xsection[:, None], np.ones(len(xsection)), rcond=None)[0]
+    return coefficients
+
+# predicted cross-section, nan for (mV, mDM) without a fit
+def predict(coefficients, process, mV, mDM, a_r, BR, G_tot):
+    prediction = np.full(len(mV), np.nan)
+    for (fit_mV, fit_mDM), fit_coefficients in coefficients.items():
+        selection = (mV == fit_mV) & (mDM == fit_mDM)
+        if not np.any(selection):
+            continue
+        degree = len(fit_coefficients) - 1
+        basis = morphing_basis(process, a_r[selection], BR[selection], G_tot[selection]/mV[selection], degree)
+        prediction[selection] = basis.dot(fit_coefficients)
+    return prediction
+
+# every n-th point (ordered by relative width) of each (mV, mDM), to emulate a small set of MadGraph runs
+def select_training_points(data, number_of_points):
+    training = np.zeros(len(data), dtype=bool)
+    for mV, mDM in set(zip(data['mV'], data['mDM'])):
+        indices = np.where((data['mV'] == mV) & (data['mDM'] == mDM))[0]
+        indices = indices[np.argsort(data['G_tot'][indices])]
+        chosen = np.unique(np.linspace(0, len(indices)-1, min(number_of_points, len(indices))).round().astype(int))
+        training[indices[chosen]] = True
+    return training
+
+def validate(filename, number_of_points, degree):
+    data = read_table(filename)
+    training = select_training_points(data, number_of_points)
+    print '%s: %s points, trained on %s' % (filename, len(data), np.sum(training))
+    for process in processes:
+        coefficients = fit_morphing(data[training], process, degree)
+        prediction = predict(coefficients, process, data['mV'], data['mDM'], data['a_r'], data['BR'], data['G_tot'])
+        xsection = data['xsection_' + process]
+        deviation = np.abs(prediction/xsection - 1)
+        deviation = deviation[np.isfinite(deviation)]
+        print '    %-14s median |rel. dev.| = %.4f, 95%% quantile = %.4f, max = %.4f' % (process, np.median(deviation), np.percentile(deviation, 95), np.max(deviation))
+
+# points of a JSON grid specification (as for calculate_MG_xsection.py -p), with widths and BRs calculated,
+# and the input parameter of the grid (g, BR or G_tot, with the precedence of ParameterSpace.calculate_all)
+def read_grid(grid_filename, mDM = 1):
+    grid_file = open(grid_filename, 'r')
+    columns = json.load(grid_file)
+    grid_file.close()
+    if not 'mDM' in columns:
+        columns['mDM'] = [mDM]
+    input_parameters = [key for key in ['g', 'BR', 'G_tot'] if key in columns]
+    if not input_parameters:
+        print 'Insufficient input parameters in %s, please provide the total width (G_tot), branching ratio (BR) or the g coupling constant (g).' % grid_filename
+        sys.exit(1)
+    kwargs = dict((key, columns[key]) for key in input_parameters)
+    grid = ParameterGrid.from_mesh(columns['mV'], columns['mDM'], columns['a_r'], **kwargs)
+    input_values = np.copy(getattr(grid, input_parameters[0]))
+    unphysical = grid.calculate_all()
+    if np.any(unphysical):
+        print 'Warning: skipping %s unphysical points' % np.sum(unphysical)
+    records = grid.to_records()[~unphysical]
+    output_data = dict((column, records[column]) for column in ['BR', 'G_tot', 'a_r', 'g', 'mDM', 'mV'])
+    # the input parameter keeps the values of the grid (the recalculated ones differ by rounding), as listed in the scan
+    output_data[input_parameters[0]] = input_values[~unphysical]
+    return output_data, input_parameters[0]
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option( "-t", "--training_table", dest = "training_table", default = 'big_table.csv',
+                  help = "Set the table with the MadGraph points used for the fit (make_results_table.py output)" )
+    parser.add_option( "-g", "--grid", dest = "grid", default = '',
+                  help = "Set the JSON grid specification of the points to predict, e.g. {\"mV\": [1000, 2000], \"a_r\": [0.1, 0.2], \"g\": [0.5, 1.0]}" )
+    parser.add_option( "-o", "--output_table", dest = "output_table", default = 'morphed_table.csv',
+                  help = "Set the output table with the predicted cross-sections (default: morphed_table.csv)" )
+    parser.add_option( "-d", "--degree", dest = "degree", default = 2,
+                  help = "Set the degree of the polynomial in G_tot/mV (default: 2)" )
+    parser.add_option( "-v", "--validate", action = "store_true", dest = "validate",
+                  help = "Validate the morphing against the full tables given as arguments (default: parameter_tables/*.csv)" )
+    parser.add_option( "-n", "--training_points", dest = "training_points", default = 5,
+                  help = "Number of training points per mass for the validation (default: 5)" )
+
+    ( options, args ) = parser.parse_args()
+
+    degree = int(options.degree)
+
+    if options.validate:
+        tables = args
+        if not tables:
+            tables = sorted('parameter_tables/' + f for f in os.listdir('parameter_tables') if f.endswith('.csv'))
+        for table in tables:
+            validate(table, int(options.training_points), degree)
+        sys.exit(0)
+
+    if not options.grid:
+        print 'Please set the grid of points to predict (-g) or run the validation (-v).'
+        sys.exit(1)
+
+    training_data = read_table(options.training_table)
+    output_data, input_parameter = read_grid(options.grid)
+
+    for process in processes:
+        coefficients = fit_morphing(training_data, process, degree)
+        output_data['xsection_' + process] = predict(coefficients, process, output_data['mV'], output_data['mDM'],
+                                                     output_data['a_r'], output_data['BR'], output_data['G_tot'])
+
+    missing = np.zeros(len(output_data['mV']), dtype=bool)
+    for process in processes:
+        missing |= np.isnan(output_data['xsection_' + process])
+    if np.any(missing):
+        print 'Warning: no training points for %s points (mV/mDM values not in %s), they are not written' % (np.sum(missing), options.training_table)
+        for column in output_data.keys():
+            output_data[column] = output_data[column][~missing]
+
+    output_table = make_table(output_data, table_columns(processes))
+    write_table(output_table, options.output_table, scan_definition(output_table, input_parameter))
+    print 'Predicted cross-sections for %s points written into %s' % (len(output_data['mV']), options.output_table)
@@ -1,12 +1,12 @@
 import numpy as np
 import os, sys
+import multiprocessing
+from functools import partial
 from optparse import OptionParser
 from cross_sections_DM import *
-from copy import copy
+from ParameterTable import read_table, read_metadata
 import ROOT
 
-gcd = ROOT.gROOT.cd
-
 processes = ['tt_exclusive', 'ttu_onshellV', 'ttu_offshellV']
 
 # Nominal model parameters
@@ -20,103 +20,191 @@ def make_folder_if_not_exists(folder):
         except:
             print "Could not create a folder ", folder
 
-def reweight_root_file(mV, process, data):
-    global output_folder, systematics, BR_run
-    root_file_prefix = 'sstops_'
-    if systematics:
-        root_file_prefix = 'SystVar_sstops_'
-
-    # slice in columns
-    a_r = data[:,2]
-    g = data[:,3]
-    BR = data[:,0]
-
+# weights of the histograms of a process at every point of the table: the cross-section over the one of the MC sample
+def process_weights(mV, process, data):
     if 'tt_excl' in process:
-        xsection = data[:,9]
+        xsection = data['xsection_tt_exclusive']
         MC_cross_section = cross_sections_tt_excl[str(mV)]
     elif 'onshell' in process:
-        xsection = data[:,8]
+        xsection = data['xsection_onshellV']
         MC_cross_section = cross_sections_onshellV[str(mV)]
     elif 'offshell' in process:
-        xsection = data[:,7]
+        xsection = data['xsection_offshellV']
         MC_cross_section = cross_sections_offshellV[str(mV)]
     else:
         print 'Unknown process: ', process
         sys.exit(1)
 
-    weights = xsection/MC_cross_section
-
-    input_root_file = ROOT.TFile(input_folder + '/' + root_file_prefix + process + '_mV' + str(mV) + '.root', "read")
-
-    for i in range(len(weights)):
-        if BR_run:
-            weight_suffix = '_a_r%.2f_BR%.2f' % (a_r[i], BR[i])
-        else:
-            weight_suffix = '_a_r%.2f_g%.2f' % (a_r[i], g[i])
-        # create the new root file with reweighted histograms
-        reweighted_root_file = ROOT.TFile(output_folder + '/' + root_file_prefix + process + '_mV' + str(mV) + weight_suffix + '.root', "recreate")
+    return xsection/MC_cross_section
 
-        # get the histograms from the input root file
-        for instance in input_root_file.GetListOfKeys():
-            histogram = input_root_file.Get(instance.GetName())
-            histogram_weighted = histogram.Clone()
-            histogram_weighted.Scale(weights[i])
-            histogram_weighted.Write(instance.GetName())
-
-        reweighted_root_file.Close()
-
-    input_root_file.Close()
+def weight_suffix(a_r, g, BR):
+    global BR_run, suffix_digits
+    if BR_run:
+        return '_a_r%.*f_BR%.*f' % (suffix_digits, a_r, suffix_digits, BR)
+    return '_a_r%.*f_g%.*f' % (suffix_digits, a_r, suffix_digits, g)
 
-def sum_files(mV, data):
-    global output_folder, systematics, BR_run
+# reweighted files of the points of the table at a mediator mass: the summed ones, or the ones of a process
+def output_filenames(mV, data, process = ''):
+    global output_folder, systematics
+    root_file_prefix = 'sstops_'
+    if systematics:
+        root_file_prefix = 'SystVar_sstops_'
+    if process:
+        root_file_prefix += process + '_'
+    return [output_folder + '/' + root_file_prefix + 'mV' + str(mV) + weight_suffix(a_r, g, BR) + '.root'
+            for a_r, g, BR in zip(data['a_r'], data['g'], data['BR'])]
+
+# all files written for the points: the summed ones and, with keep_subprocesses, the ones of every process
+def expected_filenames(mV, data, keep_subprocesses = False):
+    filenames = output_filenames(mV, data)
+    if keep_subprocesses:
+        for process in processes:
+            filenames += output_filenames(mV, data, process)
+    return filenames
+
+# file names shared by several points, as the suffixes are rounded (see -d)
+def duplicate_filenames(filenames):
+    counts = {}
+    for filename in filenames:
+        counts[filename] = counts.get(filename, 0) + 1
+    return sorted(filename for filename, count in counts.items() if count > 1)
+
+# bin contents and squared errors of all cells of a histogram (including under- and overflows), and its statistics
+# (sum of weights, of squared weights, of weight*x, ...)
+def histogram_arrays(histogram):
+    cells = range(histogram.GetNcells())
+    contents = np.array([histogram.GetBinContent(i) for i in cells])
+    sumw2 = np.array([histogram.GetBinError(i) for i in cells])**2
+    # kNstat, the size of the statistics array of all histogram types
+    stats = np.zeros(13)
+    histogram.GetStats(stats)
+    return contents, sumw2, stats
+
+# histograms of the input files of all processes at a mediator mass, as arrays (processes x cells) of bin contents,
+# squared errors and statistics, and a copy of every histogram of the first process (not owned by any file) used to write the outputs
+def read_input_histograms(mV):
+    global input_folder, systematics
     root_file_prefix = 'sstops_'
     if systematics:
         root_file_prefix = 'SystVar_sstops_'
-    
-    # slice in columns
-    a_r = data[:,2]
-    g = data[:,3]
-    BR = data[:,0]
-
-    if BR_run:
-        first_file_name = output_folder + '/' + root_file_prefix + processes[0] + '_mV' + str(mV) + '_a_r{0:.2f}'.format(a_r[0]) + '_BR{0:.2f}'.format(BR[0]) + '.root'
-    else:
-        first_file_name = output_folder + '/' + root_file_prefix + processes[0] + '_mV' + str(mV) + '_a_r{0:.2f}'.format(a_r[0]) + '_g{0:.2f}'.format(g[0]) + '.root'
-
-    first_file = ROOT.TFile(first_file_name, "read")
-    list_of_histograms = [histogram.GetName() for histogram in first_file.GetListOfKeys()]
-    first_file.Close()
-
-    for i in range(len(a_r)):
-        if BR_run:
-            weight_suffix = '_a_r%.2f_BR%.2f' % (a_r[i], BR[i])
-        else:
-            weight_suffix = '_a_r%.2f_g%.2f' % (a_r[i], g[i])
 
-        histograms_dict = {}
+    list_of_histograms = []
+    templates = {}
+    contents = {}
+    sumw2 = {}
+    stats = {}
+    entries = {}
+    for process in processes:
+        input_root_file = ROOT.TFile(input_folder + '/' + root_file_prefix + process + '_mV' + str(mV) + '.root', "read")
+        if not list_of_histograms:
+            list_of_histograms = [key.GetName() for key in input_root_file.GetListOfKeys()]
+        for histogram_name in list_of_histograms:
+            histogram = input_root_file.Get(histogram_name)
+            if not histogram_name in templates:
+                templates[histogram_name] = histogram.Clone()
+                templates[histogram_name].SetDirectory(0)
+                ROOT.SetOwnership(templates[histogram_name], True)
+            histogram_contents, histogram_sumw2, histogram_stats = histogram_arrays(histogram)
+            contents.setdefault(histogram_name, []).append(histogram_contents)
+            sumw2.setdefault(histogram_name, []).append(histogram_sumw2)
+            stats.setdefault(histogram_name, []).append(histogram_stats)
+            entries.setdefault(histogram_name, []).append(histogram.GetEntries())
+        input_root_file.Close()
+
+    for histogram_name in list_of_histograms:
+        contents[histogram_name] = np.vstack(contents[histogram_name])
+        sumw2[histogram_name] = np.vstack(sumw2[histogram_name])
+        stats[histogram_name] = np.vstack(stats[histogram_name])
+    return list_of_histograms, templates, contents, sumw2, stats, entries
+
+# linear combinations of histograms with the (points x histograms) weights, as for Scale and Add: the bin contents and
+# statistics scale with the weights, the squared errors and the sum of squared weights (statistics[1]) with the squared weights
+def weighted_arrays(weights, contents, sumw2, stats):
+    weighted_stats = weights.dot(stats)
+    weighted_stats[:, 1] = (weights**2).dot(stats[:, 1])
+    return weights.dot(contents), (weights**2).dot(sumw2), weighted_stats
+
+# writes the histograms of every point into its file, one file open at a time: the same histogram is filled and written for every point
+def write_histograms(filenames, list_of_histograms, templates, arrays, entries):
+    for i, filename in enumerate(filenames):
+        output_root_file = ROOT.TFile(filename, "recreate")
+        for histogram_name in list_of_histograms:
+            contents, sumw2, stats = arrays[histogram_name]
+            histogram = templates[histogram_name]
+            histogram.SetContent(contents[i])
+            histogram.SetError(np.sqrt(sumw2[i]))
+            histogram.PutStats(stats[i])
+            histogram.SetEntries(entries[histogram_name])
+            output_root_file.cd()
+            histogram.Write(histogram_name)
+        output_root_file.Close()
+
+# every output histogram is a linear combination of the input histograms of the processes, with the weights of the point:
+# the outputs of all points are one product of the (points x processes) weight matrix with the (processes x cells) bin contents,
+# and the squared errors the one of the squared weights with the squared errors. The reweighted histograms of the processes
+# are only written with keep_subprocesses. Returns the histograms and the files written.
+def reweight_and_sum_files(mV, data, keep_subprocesses = False):
+    filenames = expected_filenames(mV, data, keep_subprocesses)
+    duplicates = duplicate_filenames(filenames)
+    if duplicates:
+        print 'Several points of mV = %s have the same output files (e.g. %s), set more digits for the suffixes (-d)' % (mV, duplicates[0])
+        sys.exit(1)
 
-        for process in processes:
-            reweighted_root_file = ROOT.TFile(output_folder + '/' + root_file_prefix + process + '_mV' + str(mV) + weight_suffix + '.root', "read")
-            # print 'Reading from file ', output_folder + '/' + root_file_prefix + process + '_mV' + str(mV) + weight_suffix + '.root'
-            gcd()
-            
-            # sum the histograms and place in dictionary
-            for histogram_name in list_of_histograms:
-                histogram = reweighted_root_file.Get(histogram_name)
-                if histogram_name in histograms_dict:
-                    histograms_dict[histogram_name] += copy(histogram.Clone())
-                else:
-                    histograms_dict[histogram_name] = copy(histogram.Clone())
-
-            reweighted_root_file.Close()
-
-        # write histograms
-        summed_root_file = ROOT.TFile(output_folder + '/' + root_file_prefix + 'mV' + str(mV) + weight_suffix + '.root', "recreate")
-        # print 'Creating file ', output_folder + '/' + root_file_prefix + 'mV' + str(mV) + weight_suffix + '.root'
-        for histogram_name in list_of_histograms:        
-            histograms_dict[histogram_name].Write(histogram_name)
-
-        summed_root_file.Close()
+    weights = np.column_stack([process_weights(mV, process, data) for process in processes])
+
+    list_of_histograms, templates, contents, sumw2, stats, entries = read_input_histograms(mV)
+
+    arrays = {}
+    summed_entries = {}
+    for histogram_name in list_of_histograms:
+        arrays[histogram_name] = weighted_arrays(weights, contents[histogram_name], sumw2[histogram_name], stats[histogram_name])
+        summed_entries[histogram_name] = sum(entries[histogram_name])
+    write_histograms(output_filenames(mV, data), list_of_histograms, templates, arrays, summed_entries)
+
+    if not keep_subprocesses:
+        return list_of_histograms, filenames
+
+    for j, process in enumerate(processes):
+        arrays = {}
+        process_entries = {}
+        for histogram_name in list_of_histograms:
+            arrays[histogram_name] = weighted_arrays(weights[:, [j]], contents[histogram_name][[j]], sumw2[histogram_name][[j]], stats[histogram_name][[j]])
+            process_entries[histogram_name] = entries[histogram_name][j]
+        write_histograms(output_filenames(mV, data, process), list_of_histograms, templates, arrays, process_entries)
+    return list_of_histograms, filenames
+
+# work units of the reweighting: the points of every mediator mass in chunks of at most points_per_chunk
+def work_units(data, masses, points_per_chunk):
+    units = []
+    for mV in masses:
+        single_mV_data = data[data['mV']==mV]
+        for start in range(0, len(single_mV_data), points_per_chunk):
+            # a copy, not a view of the memory-mapped table, to be sent to the workers
+            units.append((mV, np.array(single_mV_data[start:start+points_per_chunk])))
+    return units
+
+# run in the worker processes, every work unit opens its own input and output files
+def reweight_work_unit(unit, keep_subprocesses = False):
+    mV, data = unit
+    list_of_histograms, filenames = reweight_and_sum_files(mV, data, keep_subprocesses)
+    return mV, len(data), list_of_histograms, filenames
+
+# files that are missing or do not have all histograms of the inputs
+def check_outputs(filenames, list_of_histograms):
+    bad_files = []
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            bad_files.append((filename, 'missing'))
+            continue
+        output_root_file = ROOT.TFile(filename, "read")
+        if output_root_file.IsZombie():
+            bad_files.append((filename, 'cannot be opened'))
+            continue
+        histograms = [key.GetName() for key in output_root_file.GetListOfKeys()]
+        output_root_file.Close()
+        if sorted(histograms) != sorted(list_of_histograms):
+            bad_files.append((filename, 'missing histograms: ' + ', '.join(sorted(set(list_of_histograms) - set(histograms)))))
+    return bad_files
 
 def clean_up_files():
     global output_folder, systematics
@@ -135,17 +223,23 @@ if __name__ == '__main__':
     parser.add_option( "-i", "--input_folder", dest= "input_folder", default = '../',
                   help = "set path with input root files to reweight" )
     parser.add_option( "-t", "--input_table", dest= "input_table", default = 'big_table.csv',
-                  help = "set a filename with the parameterization table (make_results_table.py output)" )
+                  help = "set a filename with the parameterization table (make_results_table.py output, CSV or .npy)" )
     parser.add_option( "-s", "--syst", action = "store_true", dest = "systematics",
                       help = "Reweight systematic variations (SystVar_*.root)" )
     parser.add_option( "-k", "--keep_subprocesses", action = "store_true", dest = "keep_subprocesses",
-                      help = "Keep reweighted root files for all subprocesses" )
+                      help = "Also write the reweighted root files of all subprocesses (only the summed files are written by default)" )
     parser.add_option( "-c", "--clean_up_subprocesses", action = "store_true", dest = "clean_up_subprocesses",
-                      help = "Only clean up reweighted root files for all subprocesses" )
+                      help = "Only clean up reweighted root files for all subprocesses (e.g. of an earlier run with -k)" )
     parser.add_option( "-m", "--mediator_mass", dest = "mass", default = '',
                       help = "Choose the mediator mass in GeV (1000/1500/2000/2500/3000" )
     parser.add_option( "-B", "--BR_parameters", action="store_true", dest="BR_run",
                       help="Use BR parameterisation instead of the nominal one")
+    parser.add_option( "-d", "--digits", dest = "digits", default = 2,
+                      help = "Number of digits of a_r and g (or BR) in the names of the output files (default: 2)" )
+    parser.add_option( "-j", "--jobs", dest = "jobs", default = 1,
+                      help = "Number of processes reweighting the (mediator mass, chunk of points) work units (default: 1)" )
+    parser.add_option( "-n", "--points_per_chunk", dest = "points_per_chunk", default = 0,
+                      help = "Number of points per work unit (default: the points of all masses split into about 4 units per process)" )
 
     ( options, args ) = parser.parse_args()
 
@@ -156,6 +250,7 @@ if __name__ == '__main__':
     input_table = options.input_table
     systematics = options.systematics
     BR_run = options.BR_run
+    suffix_digits = int(options.digits)
 
     if options.clean_up_subprocesses:
         print 'Cleaning up reweighted subrpocess files...'
@@ -163,24 +258,72 @@ if __name__ == '__main__':
         print 'Done.'
         sys.exit(0)
 
-    whole_data = np.genfromtxt(input_table, delimiter=',')
-    #delete first row (variable names)
-    whole_data = np.delete(whole_data, (0), axis=0)
+    # binary copy of the table (memory-mapped) if there is one
+    whole_data = read_table(input_table)
+
+    # masses and parameterisation of the scan from the description of the table, if it has one
+    metadata = read_metadata(input_table)
+    if metadata is not None and metadata['scan'] is not None:
+        mediator_masses = [int(mV) for mV in metadata['scan']['mV']]
+        if metadata['scan']['scanned_parameter'] == 'BR':
+            BR_run = True
 
     if options.mass:
         mediator_masses = [ int(options.mass) ]
-        options.keep_subprocesses = True
 
-    # work with a single mV:
-    for mV in mediator_masses:
-        print 'Working with mV = ', mV
-        single_mV_data = whole_data[whole_data[:,5]==mV]
-        for process in processes:
-            reweight_root_file(mV, process, single_mV_data)
-        sum_files(mV, single_mV_data)
+    jobs = max(1, int(options.jobs))
+    points_per_chunk = int(options.points_per_chunk)
+    if points_per_chunk <= 0:
+        number_of_points = np.sum(np.in1d(whole_data['mV'], mediator_masses))
+        points_per_chunk = max(1, int(np.ceil(float(number_of_points)/(4*jobs))))
+    units = work_units(whole_data, mediator_masses, points_per_chunk)
+
+    # the names are checked over all work units, the points of a file could be in different chunks
+    expected = []
+    for mV, data in units:
+        expected += expected_filenames(mV, data, options.keep_subprocesses)
+    duplicates = duplicate_filenames(expected)
+    if duplicates:
+        print 'Error: %s output files are shared by several points of the table, set more digits for the suffixes (-d):' % len(duplicates)
+        for filename in duplicates:
+            print '    ' + filename
+        sys.exit(1)
 
-    if not options.keep_subprocesses:
-        clean_up_files()
+    print 'Reweighting %s points in %s work units with %s processes' % (sum(len(data) for mV, data in units), len(units), jobs)
+
+    reweight = partial(reweight_work_unit, keep_subprocesses = options.keep_subprocesses)
+    results = []
+    if jobs == 1:
+        for unit in units:
+            results.append(reweight(unit))
+            print 'Done with %s points of mV = %s' % (results[-1][1], results[-1][0])
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for result in pool.imap_unordered(reweight, units):
+                results.append(result)
+                print 'Done with %s points of mV = %s (%s/%s work units)' % (result[1], result[0], len(results), len(units))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    # every expected file has to be written once, and exist with the histograms of the inputs
+    bad_files = []
+    written = []
+    for mV, number_of_points, list_of_histograms, filenames in results:
+        bad_files += check_outputs(filenames, list_of_histograms)
+        written += filenames
+    bad_files += [(filename, 'written for several points') for filename in duplicate_filenames(written)]
+    bad_files += [(filename, 'not written') for filename in sorted(set(expected) - set(written))]
+    if bad_files:
+        print 'Error: %s reweighted files are missing or incomplete:' % len(bad_files)
+        for filename, problem in bad_files:
+            print '    %s: %s' % (filename, problem)
+        sys.exit(1)
+    print 'All %s reweighted files written with all histograms.' % sum(len(result[3]) for result in results)
 
 
 
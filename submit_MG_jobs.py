@@ -1,8 +1,22 @@
-import os
+import os, sys
+import math
 import random
 import time
 import glob
+import multiprocessing
+import Queue
 from optparse import OptionParser
+import json
+import hashlib
+import subprocess as sp
+from distutils.spawn import find_executable
+import numpy as np
+import calculate_MG_xsection
+import summarise_timing
+from BatchSystem import get_batch_system, job_states
+from ResultStore import ResultStore, valid_result, read_shard, JSON_extension, shard_extension
+from ParameterSpace import ParameterGrid, quantise
+from cross_sections_DM import exclusion_cross_sections
 
 working_path = '/afs/cern.ch/user/s/ssenkin/workspace/private/MadGraph/MG5_aMC_v2_5_5'
 output_path_for_results = working_path + '/../output_JSON/'
@@ -32,37 +46,115 @@ BR_values = [x*0.1 for x in range(10)]
 BR_values[0] = 0.01
 BR_values.append(0.99)
 
+# adaptive scan: approximate excluded cross-sections [pb] used to estimate mu = excluded xsection / predicted xsection
+visible_excluded_xsection = exclusion_cross_sections['combined_2l']
+invisible_excluded_xsection = 0.03
+# narrow width approximation border
+nwa_limit = 0.1
 
-def prepare_tarball():
-    # Copy some essential code into working path
-    os.system("cp ParameterSpace.py calculate_MG_xsection.py " + working_path + '/')
-    
-    # Create the tarball if it does not exist and move to working path
-    if not os.path.isfile(working_path + '/tarball.tar.gz'):
-        print 'Creating a tarball of ' + working_path
-        os.system("tar -czf tarball.tar.gz " + working_path)
-        os.system("mv tarball.tar.gz " + working_path + "/")
-    else:
-        print 'Tarball already exists: ' + working_path + '/tarball.tar.gz, will use this one.\n'
-    return
 
+# job payload: only the scripts, the MadGraph VERSION file, the model and the compiled process directories are shipped,
+# MadGraph itself is run from the working path
+payload_scripts = ['calculate_MG_xsection.py', 'ParameterSpace.py', 'ResultStore.py']
+payload_path = working_path + '/payloads/'
+payload_name = ''
+# archive extension and extraction command
+payload_compressions = {'none' : ('.tar', 'tar -xf %s'), 'gz' : ('.tar.gz', 'tar -xzf %s'), 'zstd' : ('.tar.zst', 'zstd -dcq %s | tar -xf -')}
 
-def submit_job(signal, option):
-    # Script name and working dir name
-    foutname = "this_run" + "_" + signal + '_' + option.replace(" ","_").replace("-","").replace("=","").replace(",","").replace(":","_").replace('*','') + ".sh" # last replace to avoid having a * in file name
-    workdir  = "tmp_dir_" + signal + '_' + str(time.time()) + `random.randint(0, 1000000)`
+# (base directory, path) of the payload inputs
+def payload_inputs(reuse_process = False):
+    inputs = [(os.path.abspath('.'), script) for script in payload_scripts]
+    inputs += [(working_path, 'VERSION'), (working_path, calculate_MG_xsection.model_path)]
+    if reuse_process and os.path.isdir(working_path + '/process_cache'):
+        inputs.append((working_path, 'process_cache'))
+    return inputs
 
-    if os.path.isfile(foutname):
-        print 'Job %s already submitted.' % foutname
-        return
+def payload_file_included(filename):
+    return not filename.endswith('.pyc') and not '_tmp' in filename
 
-    # Outputdir
-    outputdir = output_path_for_results + "/"
-    os.system("mkdir -p " + outputdir)
-    os.system("mkdir -p " + outputdir + '/logs')
+# content hash of all payload inputs; the hashes of the single files are cached by size and modification time
+def payload_digest(inputs):
+    digests_filename = payload_path + 'file_digests.json'
+    cached_digests = {}
+    if os.path.isfile(digests_filename):
+        try:
+            cached_digests = json.load(open(digests_filename, 'r'))
+        except ValueError:
+            pass
+    digests = {}
+    md5 = hashlib.md5()
+    for base, path in inputs:
+        filenames = [path]
+        if os.path.isdir(base + '/' + path):
+            filenames = []
+            for root, dirs, files in os.walk(base + '/' + path):
+                dirs[:] = sorted(directory for directory in dirs if payload_file_included(directory))
+                filenames += [os.path.relpath(os.path.join(root, f), base) for f in sorted(files) if payload_file_included(f)]
+        for filename in filenames:
+            full_filename = base + '/' + filename
+            stat = os.stat(full_filename)
+            cached = cached_digests.get(full_filename)
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+                digest = cached[2]
+            else:
+                file_md5 = hashlib.md5()
+                with open(full_filename, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), ''):
+                        file_md5.update(block)
+                digest = file_md5.hexdigest()
+            digests[full_filename] = [stat.st_size, stat.st_mtime, digest]
+            md5.update(filename + ' ' + digest + '\n')
+    digests_file = open(digests_filename, 'w')
+    json.dump(digests, digests_file)
+    digests_file.close()
+    return md5.hexdigest()
 
-    # Create the bash script to be submitted
-    fout = open(foutname,"w")
+def sha256_of_file(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+# builds the payload unless one with the same content exists, returns its file name (in payload_path)
+def prepare_payload(compression = 'gz', reuse_process = False):
+    if not compression in payload_compressions:
+        print 'Unknown payload compression %s, available: %s' % (compression, ', '.join(sorted(payload_compressions.keys())))
+        sys.exit(1)
+    if compression == 'zstd' and find_executable('zstd') is None:
+        print 'Warning: zstd not found, using gzip compression for the payload'
+        compression = 'gz'
+    extension = payload_compressions[compression][0]
+    calculate_MG_xsection.make_folder_if_not_exists(payload_path)
+    inputs = payload_inputs(reuse_process)
+    name = 'payload_' + payload_digest(inputs)[:16] + extension
+    if os.path.isfile(payload_path + name) and os.path.isfile(payload_path + name + '.sha256'):
+        print 'Payload with the same content already exists: ' + payload_path + name
+        return name
+
+    print 'Creating the payload ' + payload_path + name
+    temporary_name = payload_path + name + '.tmp%d' % os.getpid()
+    command = ['tar', '-cf', temporary_name, '--exclude=*.pyc', '--exclude=*_tmp*']
+    for base, path in inputs:
+        command += ['-C', base, path]
+    if sp.call(command) != 0:
+        print 'Error: could not create the payload'
+        sys.exit(1)
+    if compression == 'gz':
+        sp.call(['gzip', '-f', temporary_name])
+        os.rename(temporary_name + '.gz', temporary_name)
+    elif compression == 'zstd':
+        sp.call(['zstd', '-q', '-f', '--rm', temporary_name, '-o', temporary_name + '.zst'])
+        os.rename(temporary_name + '.zst', temporary_name)
+    checksum_file = open(payload_path + name + '.sha256', 'w')
+    checksum_file.write(sha256_of_file(temporary_name) + '  ' + name + '\n')
+    checksum_file.close()
+    os.rename(temporary_name, payload_path + name)
+    print 'Payload size: %.1f MB' % (os.path.getsize(payload_path + name) / 1e6)
+    return name
+
+# beginning of a job script: unpacks the payload in a temporary working directory
+def write_job_setup(fout, workdir):
     fout.write('#!/bin/bash\n')
     fout.write('source /etc/profile\n')
     fout.write('# Working area\n')
@@ -71,60 +163,611 @@ def submit_job(signal, option):
     fout.write('WorkingDirectory=work_${RandomDirectory}\n')
     fout.write('mkdir -p $WorkingDirectory\n')
     fout.write('cd $WorkingDirectory\n')
+    # the results are appended to one shard per job, published under a name unique to every attempt of the job
+    fout.write('ResultShard=${RandomDirectory}_$(date +%s)_$$' + shard_extension + '\n')
     fout.write('\n')
-    fout.write('# Grab the code\n')
-    fout.write('cp -f ' + working_path + '/tarball.tar.gz .\n')
-    fout.write('tar -xzf tarball.tar.gz\n')
-    fout.write('echo "untaring done!"\n')
-    fout.write('cd ' + working_path[1:] + '\n') # [1:] to remove the first character, which is '/'. That way, we stay in the temporary directory.
-    fout.write('ls\n')
+    fout.write('# Grab the code and verify it\n')
+    fout.write('cp -f ' + payload_path + payload_name + ' ' + payload_path + payload_name + '.sha256 .\n')
+    fout.write('sha256sum -c --quiet ' + payload_name + '.sha256 || { echo "payload checksum mismatch"; exit 1; }\n')
+    for extension, extraction in payload_compressions.values():
+        if payload_name.endswith(extension):
+            fout.write(extraction % payload_name + '\n')
+    fout.write('rm -f ' + payload_name + '\n')
+    fout.write('echo "unpacking done!"\n')
     fout.write('\n')
     fout.write('echo "setup done"\n')
     fout.write('\n')
+
+# copies the result shard and the logs of the job to the output directory,
+# the shard is replaced by a rename, so that it is never read half copied
+def write_copy_outputs(fout, outputdir):
+    fout.write('if [ -f output_JSON/' + job_result_shard + ' ]; then\n')
+    fout.write('    cp -f output_JSON/' + job_result_shard + ' ' + outputdir + '/${ResultShard}.part && mv -f ' + outputdir + '/${ResultShard}.part ' + outputdir + '/${ResultShard}\n')
+    fout.write('fi\n')
+    fout.write('cp -rf output_JSON/logs ' + outputdir + '/.\n')
+    fout.write('cp -rf workspace/*out ' + outputdir + '/logs/.\n')
+
+def submit_job(signal, option, extra_options = '', minutes = 8):
+    # Script name and working dir name
+    foutname = "this_run" + "_" + signal + '_' + option.replace(" ","_").replace("-","").replace("=","").replace(",","").replace(":","_").replace('*','') + ".sh" # last replace to avoid having a * in file name
+    workdir  = "tmp_dir_" + signal + '_' + str(time.time()) + `random.randint(0, 1000000)`
+
+    if os.path.isfile(foutname):
+        print 'Job %s already submitted.' % foutname
+        return
+
+    # Outputdir
+    outputdir = output_path_for_results + "/"
+    os.system("mkdir -p " + outputdir)
+    os.system("mkdir -p " + outputdir + '/logs')
+
+    # Create the bash script to be submitted
+    fout = open(foutname,"w")
+    write_job_setup(fout, workdir)
     fout.write('# Create the config file for the studied signal, and run MG\n')
-    fout.write('python calculate_MG_xsection.py -s ' + signal + ' ' + option+'\n')
+    fout.write('python calculate_MG_xsection.py -s ' + signal + ' ' + option + extra_options + '\n')
     fout.write('\n')
     fout.write('# Copy outputs  \n')
-    fout.write('cp -rf output_JSON/* ' + outputdir + '/.\n')
-    fout.write('cp -rf workspace/*out ' + outputdir + '/logs/.\n')
+    write_copy_outputs(fout, outputdir)
     fout.write('cd ' + working_path + '\n')
     fout.write('rm -rf ${WorkingDirectory}\n')
     fout.close();
 
-    # Launch the batch job command (lxplus)
+    # Launch the batch job command
     os.system("chmod +x " + foutname)
-    os.system("bsub -q 8nm " + os.path.abspath(foutname) )
+    batch_system.submit(foutname, minutes)
     return
 
-def resubmit_job(process, mV, mDM, a_r, value):
+def scan_point(mV, a_r, value):
+    global options
+    point = {'mV' : mV, 'mDM' : mDM, 'a_r' : a_r}
+    if options.BR_run:
+        point['BR'] = value
+    else:
+        point['g'] = value
+    return point
+
+# shard the results of a batch job are appended to, in its output_JSON
+job_result_shard = 'results' + shard_extension
+
+# options of calculate_MG_xsection.py common to all jobs
+def job_extra_options():
+    global options
+    # MadGraph is not in the payload
+    extra_options = ' -e ' + working_path + '/bin/mg5_aMC -J ' + job_result_shard
+    if options.reuse_process:
+        extra_options += ' -c'
+    if float(options.precision):
+        extra_options += ' -x -P ' + str(options.precision)
+    if int(options.width_check_every):
+        extra_options += ' -W -K ' + str(options.width_check_every)
+    return extra_options
+
+# command line options of calculate_MG_xsection.py for a point
+def point_option(point):
+    option = '-a ' + str(point['a_r']) + ' -M ' + str(point['mV'])
+    if 'BR' in point:
+        return option + ' -B ' + str(point['BR'])
+    return option + ' -g ' + str(point['g'])
+
+def point_value(point):
+    if 'BR' in point:
+        return point['BR']
+    return point['g']
+
+# measured runtime per point in minutes by (process, mV) and by process, from the timing records of finished jobs
+# features of the runtime model: log(mV), log(a_r) and log(g), the widths and phase space grow with them
+def runtime_features(mV, a_r, g):
+    return [1., math.log(mV), math.log(a_r), math.log(g)]
+
+# minimum number of timing samples of a process (with at least two masses) for the fit of the runtime model
+runtime_fit_minimum = 10
+
+# runtime model from the timing records of finished jobs: per process a fit of
+# log(runtime per point) = c0 + c1 log(mV) + c2 log(a_r) + c3 log(g), and the median runtimes
+# by (process, mV) and by process as fallbacks while there are too few records for the fit
+def runtime_model():
+    model = {'fits' : {}, 'medians' : {}}
+    if not os.path.isdir(output_path_for_results + '/logs'):
+        return model
+    samples = {}
+    medians = {}
+    for record in summarise_timing.read_timing_records(output_path_for_results + '/logs'):
+        runtime = record['wall_time'] / 60 / record['number_of_points']
+        for i, mV in enumerate(record['mV']):
+            medians.setdefault((record['process'], mV), []).append(runtime)
+            medians.setdefault(record['process'], []).append(runtime)
+            # records of older jobs do not have the couplings
+            if 'g' in record and runtime > 0 and record['a_r'][i] > 0 and record['g'][i] > 0:
+                samples.setdefault(record['process'], []).append((runtime_features(mV, record['a_r'][i], record['g'][i]), math.log(runtime)))
+    model['medians'] = dict((key, np.median(values)) for key, values in medians.items())
+    for process, process_samples in samples.items():
+        features = np.array([sample[0] for sample in process_samples])
+        if len(process_samples) < runtime_fit_minimum or len(set(features[:, 1])) < 2:
+            continue
+        model['fits'][process] = np.linalg.lstsq(features, np.array([sample[1] for sample in process_samples]), rcond = None)[0]
+    return model
+
+# predicted runtime of a point in minutes
+def predicted_runtime(model, process, point):
+    global options
+    if process in model['fits']:
+        g = point.get('g')
+        if g is None:
+            grid = ParameterGrid(point['mV'], point['mDM'], point['a_r'], BR = point['BR'])
+            grid.calculate_all()
+            g = grid.g[0]
+        if point['a_r'] > 0 and g > 0:
+            return math.exp(np.dot(model['fits'][process], runtime_features(point['mV'], point['a_r'], g)))
+    if (process, point['mV']) in model['medians']:
+        return model['medians'][(process, point['mV'])]
+    return model['medians'].get(process, float(options.default_runtime))
+
+# splits the points into packs of a fixed number of points, or of a target runtime (in minutes) by first-fit
+# decreasing packing of the predicted runtimes. The packs are returned longest first, to minimise the makespan.
+def pack_points(job_points, points_per_job = 0, target_runtime = 0, model = None):
+    runtimes = [predicted_runtime(model, process, point) for process, point in job_points]
+    ordered_points = [job_points[i] for i in np.argsort(runtimes)[::-1]]
+    ordered_runtimes = sorted(runtimes, reverse = True)
+    packs = []
+    if points_per_job:
+        for i in range(0, len(ordered_points), points_per_job):
+            packs.append((ordered_points[i:i+points_per_job], sum(ordered_runtimes[i:i+points_per_job])))
+    else:
+        for point, runtime in zip(ordered_points, ordered_runtimes):
+            for pack in packs:
+                if pack[1] + runtime <= target_runtime:
+                    pack[0].append(point)
+                    pack[1] += runtime
+                    break
+            else:
+                packs.append([[point], runtime])
+        packs = [tuple(pack) for pack in packs]
+    return sorted(packs, key = lambda pack: -pack[1])
+
+# wall time requested for a resubmission: the predicted runtime, but at least twice the time requested before,
+# as the job may have been killed at the time limit
+def resubmission_minutes(script, predicted_minutes):
+    previous = batch_system.jobs.get(os.path.abspath(script), {})
+    return max(predicted_minutes, 2 * previous.get('minutes', 0))
+
+# one job script for many points: the payload is unpacked once, the points are run one after the other and their
+# results copied as soon as they are done. The manifest (this_run_pack_*.json) lists the points of the job for the
+# resubmission, the job itself records the status of every point in logs/this_run_pack_*.status
+def submit_packed_job(points, extra_options = '', estimated_minutes = 0, resubmit = False):
+    job_name = 'this_run_pack_' + hashlib.md5(json.dumps(points, sort_keys = True) + extra_options).hexdigest()[:12]
+    foutname = job_name + '.sh'
+    workdir  = "tmp_dir_" + job_name + '_' + str(time.time()) + `random.randint(0, 1000000)`
+
+    if os.path.isfile(foutname):
+        if resubmit:
+            if batch_system.resubmit(foutname, resubmission_minutes(foutname, estimated_minutes)) is None:
+                print 'Job %s is still pending or running, not resubmitted.' % foutname
+            else:
+                print 'Resubmitted job %s with %s points (estimated %.0f min)' % (foutname, len(points), estimated_minutes)
+        else:
+            print 'Job %s already submitted.' % foutname
+        return
+
+    outputdir = output_path_for_results + "/"
+    os.system("mkdir -p " + outputdir)
+    os.system("mkdir -p " + outputdir + '/logs')
+    status_filename = outputdir + '/logs/' + job_name + '.status'
+
+    manifest = {'job' : job_name, 'script' : os.path.abspath(foutname), 'extra_options' : extra_options,
+                'estimated_minutes' : estimated_minutes, 'points' : [{'process' : process, 'point' : point} for process, point in points]}
+    manifest_file = open(job_name + '.json', 'w')
+    manifest_file.write(json.dumps(manifest, sort_keys = True, indent = 4))
+    manifest_file.close()
+
+    fout = open(foutname,"w")
+    write_job_setup(fout, workdir)
+    fout.write('# Run MG for every point of the job\n')
+    for process, point in points:
+        option = point_option(point)
+        fout.write('python calculate_MG_xsection.py -s ' + process + ' ' + option + extra_options + ' && status=done || status=failed\n')
+        fout.write('echo "$status ' + process + ' ' + option + '" >> ' + status_filename + '\n')
+        write_copy_outputs(fout, outputdir)
+        # the MadEvent directories of finished points are not needed any more
+        fout.write('find workspace -mindepth 1 -maxdepth 1 -type d -exec rm -rf {} +\n')
+        fout.write('\n')
+    fout.write('cd ' + working_path + '\n')
+    fout.write('rm -rf ${WorkingDirectory}\n')
+    fout.close()
+
+    os.system("chmod +x " + foutname)
+    print 'Submitting job %s with %s points (estimated %.0f min)' % (foutname, len(points), estimated_minutes)
+    batch_system.submit(foutname, estimated_minutes)
+
+# points of all packed jobs already submitted, from their manifests
+def packed_job_points():
+    points = []
+    for manifest_filename in sorted(glob.glob('this_run_pack_*.json')):
+        manifest = json.load(open(manifest_filename, 'r'))
+        points += [(entry['process'], entry['point']) for entry in manifest['points']]
+    return points
+
+# points of all packed jobs (from their manifests) without output, reported per job; the points of jobs still
+# pending or running are left to them, as for single point jobs in resubmit_job
+def missing_packed_points():
+    missing = []
+    for manifest_filename in sorted(glob.glob('this_run_pack_*.json')):
+        manifest = json.load(open(manifest_filename, 'r'))
+        job_missing = [(entry['process'], entry['point']) for entry in manifest['points']
+                       if not point_done(entry['process'], entry['point']['mV'], entry['point']['mDM'], entry['point']['a_r'], point_value(entry['point']))]
+        if job_missing and batch_system.is_active(manifest['script']):
+            print 'Job %s: %s of %s points without output, but the job is still pending or running' % (manifest['job'], len(job_missing), len(manifest['points']))
+            continue
+        if job_missing:
+            print 'Job %s: %s of %s points without output' % (manifest['job'], len(job_missing), len(manifest['points']))
+        missing += [point for point in job_missing if not point in missing]
+    return missing
+
+# content of an output file, None if it is truncated, corrupt or incomplete
+def read_output(filename):
+    try:
+        input_file = open(filename, 'r')
+        data = json.load(input_file)
+        input_file.close()
+    except (IOError, ValueError):
+        return None
+    if not valid_result(data):
+        return None
+    return data
+
+# valid outputs from a single listing of the output directory: the JSON files and the result shards. The index is
+# cached in logs/output_index.json, with the content of the JSON files and, as the shards are append-only, the results
+# and the read offset of every shard, so that every output is only read once over all resubmissions.
+# Corrupt JSON files are reported, and moved to the corrupt/ subdirectory if move_corrupt is set,
+# corrupt lines of the shards are reported when they are read and skipped.
+def read_output_index(move_corrupt = False):
+    # kept in the logs, as every result in the output directory is read by make_results_table.py
+    calculate_MG_xsection.make_folder_if_not_exists(output_path_for_results + '/logs')
+    index_filename = output_path_for_results + '/logs/output_index.json'
+    cached_index = {'files' : {}, 'shards' : {}}
+    if os.path.isfile(index_filename):
+        try:
+            cached_index = json.load(open(index_filename, 'r'))
+        except ValueError:
+            print 'Warning: can not read the output index %s, rebuilding it' % index_filename
+    if not 'shards' in cached_index:
+        # index of the JSON files only, without their sizes and modification times: read again
+        cached_index = {'files' : {}, 'shards' : {}}
+    index = {'files' : {}, 'shards' : {}}
+    corrupt_outputs = []
+    corrupt_lines = 0
+    for filename in os.listdir(output_path_for_results):
+        path = output_path_for_results + '/' + filename
+        if filename.endswith(shard_extension):
+            shard = cached_index['shards'].get(filename, {'offset' : 0, 'results' : []})
+            # a shard is only ever extended, unless it is replaced
+            if os.path.getsize(path) < shard['offset']:
+                shard = {'offset' : 0, 'results' : []}
+            shard = {'offset' : shard['offset'], 'results' : list(shard['results'])}
+            for data, offset in read_shard(path, shard['offset']):
+                if data is None:
+                    corrupt_lines += 1
+                else:
+                    shard['results'].append(data)
+                shard['offset'] = offset
+            index['shards'][filename] = shard
+            continue
+        if not filename.endswith(JSON_extension):
+            continue
+        # [size, modification time, contents] of a JSON file: a file rewritten (e.g. by a resubmitted job) is read again
+        stat = os.stat(path)
+        cached = cached_index['files'].get(filename)
+        if isinstance(cached, list) and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            data = cached[2]
+        else:
+            data = read_output(path)
+        if data is None:
+            corrupt_outputs.append(filename)
+            continue
+        index['files'][filename] = [stat.st_size, stat.st_mtime, data]
+    if index != cached_index:
+        index_file = open(index_filename + '.tmp', 'w')
+        json.dump(index, index_file)
+        index_file.close()
+        os.rename(index_filename + '.tmp', index_filename)
+    if corrupt_lines:
+        print 'Warning: %s corrupt lines in the result shards, skipped' % corrupt_lines
+    if corrupt_outputs:
+        print 'Warning: %s corrupt or incomplete outputs: %s' % (len(corrupt_outputs), ', '.join(sorted(corrupt_outputs)))
+        if move_corrupt:
+            calculate_MG_xsection.make_folder_if_not_exists(output_path_for_results + '/corrupt')
+            for filename in corrupt_outputs:
+                os.rename(output_path_for_results + '/' + filename, output_path_for_results + '/corrupt/' + filename)
+            print 'Corrupt outputs moved to ', output_path_for_results + '/corrupt'
+    return [index['files'][filename][2] for filename in sorted(index['files'])] + \
+           [data for filename in sorted(index['shards']) for data in index['shards'][filename]['results']]
+
+def point_key(process, mV, mDM, a_r, value):
+    return (process, quantise(mV), quantise(mDM), quantise(a_r), quantise(value))
+
+# indexed lookup in the result store, for the model and MadGraph versions of the working path
+def point_in_result_store(process, mV, mDM, a_r, value):
+    global options, result_store, versions
+    if process == calculate_MG_xsection.combined_subprocess:
+        return all(point_in_result_store(single_process, mV, mDM, a_r, value) for single_process in calculate_MG_xsection.combined_subprocesses)
+    if options.BR_run:
+        return result_store.contains(process, mV, mDM, a_r, BR = value, **versions)
+    else:
+        return result_store.contains(process, mV, mDM, a_r, g = value, **versions)
+
+def point_done(process, mV, mDM, a_r, value):
+    global result_store
+    if result_store is not None:
+        return point_in_result_store(process, mV, mDM, a_r, value)
+    results = load_results()
+    if process == calculate_MG_xsection.combined_subprocess:
+        return all(point_key(single_process, mV, mDM, a_r, value) in results for single_process in calculate_MG_xsection.combined_subprocesses)
+    return point_key(process, mV, mDM, a_r, value) in results
+
+def resubmit_job(process, mV, mDM, a_r, value, minutes = 60):
     global options
+    point = '%s mV = %s, a_r = %s, %s = %s' % (process, mV, a_r, options.BR_run and 'BR' or 'g', value)
     if options.BR_run:
-        filename = output_path_for_results + process + '_mV%.0f_mDM%.0f_a_r%.2f_BR%.2f.txt' % (mV, mDM, a_r, value)
         foutname = "this_run" + "_" + process + '_a_' + str(a_r) + '_M_' + str(mV) + '_B_' + str(value) + '.sh'
     else:
-        filename = output_path_for_results + process + '_mV%.0f_mDM%.0f_a_r%.2f_g%.2f.txt' % (mV, mDM, a_r, value)
         foutname = "this_run" + "_" + process + '_a_' + str(a_r) + '_M_' + str(mV) + '_g_' + str(value) + '.sh'
     job_resubmitted = False
-    if not os.path.isfile(filename):
-        print 'File ' + filename.replace(output_path_for_results,'') + ' does not exist, resubmitting job with command ' + "bsub -q 1nh " + os.path.abspath(foutname)
-        os.system("bsub -q 1nh " + os.path.abspath(foutname) )
-        job_resubmitted = True
+    if not point_done(process, mV, mDM, a_r, value):
+        if batch_system.is_active(foutname):
+            print 'No output for ' + point + ', but job ' + foutname + ' is still pending or running'
+            return job_resubmitted
+        print 'No output for ' + point + ', resubmitting job ' + os.path.abspath(foutname) + ' (%s)' % batch_system.name
+        job_resubmitted = batch_system.resubmit(foutname, resubmission_minutes(foutname, minutes)) is not None
     return job_resubmitted
 
+# all available results, keyed by point_key, from the result store or the output index,
+# read once and kept in memory until refreshed (e.g. in every iteration of the adaptive scan)
+def load_results(refresh = False):
+    global options, result_store, loaded_results
+    if loaded_results is not None and not refresh:
+        return loaded_results
+    if result_store is not None:
+        list_of_results = result_store.results()
+    else:
+        list_of_results = read_output_index(move_corrupt = options.resubmit)
+    scanned_parameter = 'g'
+    if options.BR_run:
+        scanned_parameter = 'BR'
+    loaded_results = {}
+    for data in list_of_results:
+        loaded_results[point_key(data['process'], data['mV'], data['mDM'], data['a_r'], data[scanned_parameter])] = data
+    return loaded_results
+
+def coarse_indices(n, step):
+    indices = range(0, n, step)
+    if indices[-1] != n-1:
+        indices.append(n-1)
+    return indices
+
+# indices of the (a_r, value) lattice to calculate: the coarse lattice, refined by halving every cell for which
+# needs_refinement(corners) is True, down to neighbouring lattice points (target resolution).
+# needs_refinement returns None while results for the corners are missing.
+def adaptive_scan_indices(n_a_r, n_values, coarse_step, needs_refinement):
+    a_r_indices = coarse_indices(n_a_r, coarse_step)
+    value_indices = coarse_indices(n_values, coarse_step)
+    needed = set((i, j) for i in a_r_indices for j in value_indices)
+    cells = [(i0, i1, j0, j1) for i0, i1 in zip(a_r_indices, a_r_indices[1:]) for j0, j1 in zip(value_indices, value_indices[1:])]
+    while cells:
+        new_cells = []
+        for i0, i1, j0, j1 in cells:
+            if i1 - i0 <= 1 and j1 - j0 <= 1:
+                continue
+            if not needs_refinement([(i0, j0), (i0, j1), (i1, j0), (i1, j1)]):
+                continue
+            i_split = sorted(set([i0, (i0+i1)//2, i1]))
+            j_split = sorted(set([j0, (j0+j1)//2, j1]))
+            needed.update((i, j) for i in i_split for j in j_split)
+            new_cells += [(ia, ib, ja, jb) for ia, ib in zip(i_split, i_split[1:]) for ja, jb in zip(j_split, j_split[1:])]
+        cells = new_cells
+    return needed
+
+# True if the mu = 1 contour (visible or invisible) or the G_tot/mV = nwa_limit line crosses the cell
+def cell_needs_refinement(mV, corners, values, results):
+    global options
+    a_r = np.array([a_r_couplings[i] for i, j in corners])
+    value = np.array([values[j] for i, j in corners])
+    xsections = {}
+    for process in processes:
+        xsections[process] = []
+        for point_a_r, point_value in zip(a_r, value):
+            key = point_key(process, mV, mDM, point_a_r, point_value)
+            if not key in results:
+                return None
+            xsections[process].append(results[key]['xsection'])
+        xsections[process] = np.array(xsections[process])
+
+    mu_visible = visible_excluded_xsection / (xsections['tt_exclusive'] + xsections['onshellV'] + xsections['offshellV'])
+    mu_invisible = invisible_excluded_xsection / xsections['monotop']
+
+    if options.BR_run:
+        grid = ParameterGrid(mV, mDM, a_r, BR=value)
+    else:
+        grid = ParameterGrid(mV, mDM, a_r, g=value)
+    grid.calculate_all()
+    relative_width = grid.G_tot / grid.mV
+
+    for quantity, threshold in [(mu_visible, 1), (mu_invisible, 1), (relative_width, nwa_limit)]:
+        if np.any(quantity < threshold) and np.any(quantity >= threshold):
+            return True
+    return False
+
+# (a_r, value) points to calculate for a mediator mass: the full grid, or the adaptively refined one
+def scan_points(mV, values, results = None):
+    global options
+    if not int(options.adaptive_step):
+        return [(a_r, value) for a_r in a_r_couplings for value in values]
+    needs_refinement = lambda corners: cell_needs_refinement(mV, corners, values, results)
+    indices = adaptive_scan_indices(len(a_r_couplings), len(values), int(options.adaptive_step), needs_refinement)
+    return [(a_r_couplings[i], values[j]) for i, j in sorted(indices)]
+
+# slot of a local worker (0 ... number of workers - 1): its compiled process directories are kept in process_cache_<slot>,
+# so that they are reused by the workers of later local scans
+worker_slot = None
+
+def init_local_worker(slots):
+    global worker_slot
+    try:
+        worker_slot = slots.get(timeout = 60)
+    except Queue.Empty:
+        # a worker replacing one that died, whose slot is not given back
+        worker_slot = 'pid%d' % os.getpid()
+
+# runs a single point in-process inside its own workspace, called by the local process pool
+def run_local_job(job):
+    global worker_slot
+    process, point, workspace_root, output_path, nb_core, reuse_process, result_store_filename, precision, width_check_every = job
+    start_time = time.time()
+    status = 'done'
+    file_name_suffix = '_'.join(str(value) for value in point.values())
+    stdout = sys.stdout
+    try:
+        parameters, file_name_suffix, auto_width = calculate_MG_xsection.prepare_point(verbose = False, **point)
+        job_workspace = workspace_root + '/' + process + '_' + file_name_suffix
+        calculate_MG_xsection.make_folder_if_not_exists(job_workspace)
+        # keep the python output of every job next to its MadGraph output
+        sys.stdout = open(job_workspace + '/log.txt', 'w')
+        # the compiled process directories are shared by the jobs of a worker slot, never between workers
+        calculate_MG_xsection.set_paths(job_workspace, output_path, workspace_root + '/process_cache_%s' % worker_slot)
+        calculate_MG_xsection.set_result_store(result_store_filename)
+        # one result shard per worker, appended to by its jobs one after the other
+        calculate_MG_xsection.set_result_shard('results_local_%s_%d%s' % (os.uname()[1], os.getpid(), shard_extension))
+        missing_points, mismatched_points = calculate_MG_xsection.calculate_MG_xsections(process, [parameters], [file_name_suffix], file_name_suffix, auto_width, reuse_process, nb_core, precision, width_check_every)
+        if missing_points:
+            status = 'no MadGraph output'
+        elif mismatched_points:
+            status = 'mismatching parameters'
+    except (Exception, SystemExit) as e:
+        status = 'failed (%s)' % e
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return process, file_name_suffix, status, time.time() - start_time
+
+# local stand-in for the batch system: a bounded pool of MG runs with nb_core cores each
+def run_local_jobs(jobs, total_cores, nb_core, workspace_root):
+    number_of_workers = max(1, total_cores // max(1, nb_core))
+    print 'Running %s jobs locally with %s workers, %s core(s) per MadGraph run' % (len(jobs), number_of_workers, max(1, nb_core))
+    calculate_MG_xsection.make_folder_if_not_exists(workspace_root)
+
+    slots = multiprocessing.Queue()
+    for slot in range(number_of_workers):
+        slots.put(slot)
+    pool = multiprocessing.Pool(number_of_workers, init_local_worker, (slots,))
+    start_time = time.time()
+    failed_jobs = 0
+    try:
+        for i, (process, file_name_suffix, status, runtime) in enumerate(pool.imap_unordered(run_local_job, jobs)):
+            if status != 'done':
+                failed_jobs += 1
+            print '[%s/%s] %s %s: %s in %.1f min (total %.1f min)' % (i+1, len(jobs), process, file_name_suffix, status, runtime/60, (time.time()-start_time)/60)
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed_jobs
+
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option( "-r", "--resubmit", action = "store_true", dest = "resubmit",
                       help = "Resubmit jobs with no output/" )
     parser.add_option( "-B", "--BR_parameters", action="store_true", dest="BR_run",
                       help="Use BR parameterisation to read the input limit files")    
+    parser.add_option( "-l", "--local", dest = "local_cores", default = 0,
+                      help = "Run the scan on this machine with a process pool using this many cores in total, instead of submitting batch jobs (run from the MadGraph directory)" )
+    parser.add_option( "-n", "--cores_per_run", dest = "cores_per_run", default = 1,
+                      help = "Number of cores used by each local MadGraph run (default: 1)" )
+    parser.add_option( "-w", "--local_workspace", dest = "local_workspace", default = 'local_workspace',
+                      help = "Directory holding the workspaces of the local MadGraph runs (default: local_workspace)" )
+    parser.add_option( "-S", "--result_store", dest = "result_store", default = '',
+                      help = "Result store (SQLite file, see make_results_table.py -S): points already in it are skipped" )
+    parser.add_option( "-A", "--adaptive", dest = "adaptive_step", default = 0,
+                      help = "Adaptive scan: start from every N-th a_r and g/BR value and refine only the cells crossed by the mu = 1 contours or the G_tot/mV = 0.1 line. With batch jobs, rerun with -A once they are done" )
+    parser.add_option( "-c", "--reuse_process", action = "store_true", dest = "reuse_process",
+                      help = "Reuse the compiled MadEvent process directories (process_cache in the working path, shipped with the tarball)" )
+
+    parser.add_option( "-x", "--xsection_only", dest = "precision", default = 0,
+                      help = "Fast mode: only integrate the cross-sections to this relative precision, without the full event generation (e.g. 0.01)" )
+
+    parser.add_option( "-W", "--analytic_width", dest = "width_check_every", default = 0,
+                      help = "Give the analytic widths to MadGraph and cross-check them with MadGraph for 1 in this many points (e.g. 50)" )
+
+    parser.add_option( "-a", "--all_in_one", action = "store_true", dest = "all_in_one",
+                      help = "Calculate all subprocesses of a point in one MadGraph run (one job per point instead of one per subprocess)" )
+
+    parser.add_option( "-k", "--pack", dest = "points_per_job", default = 0,
+                      help = "Job packing: run this many points in one batch job (the payload is unpacked once per job)" )
+    parser.add_option( "-T", "--pack_runtime", dest = "pack_runtime", default = 0,
+                      help = "Job packing: fill each batch job up to this runtime in minutes, using the runtimes predicted from the timing records of finished points" )
+    parser.add_option( "-D", "--default_runtime", dest = "default_runtime", default = 10,
+                      help = "Runtime per point in minutes assumed when none has been measured yet, for the job packing and the queue or wall time of the jobs (default: 10)" )
+
+    parser.add_option( "-b", "--batch_system", dest = "batch_system", default = 'lsf',
+                      help = "Batch system used to submit the jobs: lsf, condor, slurm or local (queue directory run by python BatchSystem.py), default: lsf" )
+    parser.add_option( "-Q", "--queue_path", dest = "queue_path", default = 'local_queue',
+                      help = "Queue directory of the local batch system (default: local_queue)" )
+    parser.add_option( "--status", action = "store_true", dest = "status",
+                      help = "Print the status of the submitted jobs and exit" )
+    parser.add_option( "--cancel", action = "store_true", dest = "cancel",
+                      help = "Cancel all pending and running submitted jobs and exit" )
+
+    parser.add_option( "-Z", "--payload_compression", dest = "payload_compression", default = 'gz',
+                      help = "Compression of the job payload: none, gz or zstd (default: gz)" )
 
     ( options, args ) = parser.parse_args()
 
+    batch_system = get_batch_system(options.batch_system, queue_path = options.queue_path)
+
+    if options.status:
+        states = batch_system.status()
+        print 'Jobs submitted with %s: %s' % (batch_system.name, len(states))
+        for state in job_states:
+            print '    %-10s %s' % (state, states.values().count(state))
+        for script, state in sorted(states.items()):
+            if state == 'failed':
+                print 'Failed job: ', script
+        sys.exit(0)
+
+    if options.cancel:
+        print 'Cancelled %s jobs' % batch_system.cancel()
+        sys.exit(0)
+
     # Create output directory if it is not there
     os.system("mkdir -p " + output_path_for_results)
 
-    if not options.resubmit:
-        prepare_tarball()
+    local_run = int(options.local_cores) > 0
+
+    loaded_results = None
+    result_store = None
+    result_store_filename = ''
+    versions = {}
+    if options.result_store:
+        result_store_filename = os.path.abspath(options.result_store)
+        result_store = ResultStore(result_store_filename)
+        # only results of the same model and MadGraph versions count as done
+        MG_path = working_path
+        if local_run:
+            MG_path = '.'
+        if os.path.isdir(MG_path + '/' + calculate_MG_xsection.model_path):
+            versions = {'model_version' : calculate_MG_xsection.model_version(MG_path), 'MG_version' : calculate_MG_xsection.MG_version(MG_path)}
+        print 'Using result store %s with %s results' % (result_store_filename, len(result_store))
+
+    packing = int(options.points_per_job) > 0 or float(options.pack_runtime) > 0
+    submitted_packed_points = []
+    if packing:
+        submitted_packed_points = packed_job_points()
+
+    # the resubmission of single point jobs reuses their scripts and payloads
+    if not local_run and (not options.resubmit or packing):
+        payload_name = prepare_payload(options.payload_compression, options.reuse_process)
 
     all_jobs_done = True
     job_counter = 0
@@ -134,23 +777,87 @@ if __name__ == '__main__':
     else:
         array = g_couplings
 
-    for process in processes:
-        for mV in mediator_masses:
-            for a_r in a_r_couplings:
-                for value in array:
-                    if options.resubmit:
-                        job_resubmitted = resubmit_job(process, mV, mDM, a_r, value)
-                        if job_resubmitted:
-                            job_counter += 1
-                            all_jobs_done = False
-                    else:
-                        if options.BR_run:
-                            submit_job(process, '-a ' + str(a_r) + ' -M ' + str(mV) + ' -B ' + str(value))   
-                        else:
-                            submit_job(process, '-a ' + str(a_r) + ' -M ' + str(mV) + ' -g ' + str(value))
+    adaptive = int(options.adaptive_step) > 0
+
+    job_processes = processes
+    if options.all_in_one:
+        job_processes = [calculate_MG_xsection.combined_subprocess]
+    attempted_jobs = set()
+
+    while True:
+        # the adaptive scan picks the points to calculate from the results available so far
+        results = None
+        if adaptive:
+            results = load_results(refresh = True)
+            print 'Adaptive scan: %s results available' % len(results)
+
+        local_jobs = []
+        packed_points = []
+        single_points = []
+        for process in job_processes:
+            for mV in mediator_masses:
+                for a_r, value in scan_points(mV, array, results):
+                    if options.resubmit and not local_run and packing:
+                        # the points to resubmit come from the manifests of the packed jobs
+                        continue
+                    elif options.resubmit and not local_run:
+                        single_points.append((process, scan_point(mV, a_r, value), value))
+                    elif local_run:
+                        if (options.resubmit or adaptive or result_store is not None) and point_done(process, mV, mDM, a_r, value):
+                            continue
+                        if (process, mV, a_r, value) in attempted_jobs:
+                            continue
+                        attempted_jobs.add((process, mV, a_r, value))
+                        point = scan_point(mV, a_r, value)
+                        local_jobs.append((process, point, os.path.abspath(options.local_workspace), output_path_for_results, int(options.cores_per_run), options.reuse_process, result_store_filename, float(options.precision), int(options.width_check_every)))
                         job_counter += 1
-                    
-    
+                        all_jobs_done = False
+                    else:
+                        if result_store is not None and point_in_result_store(process, mV, mDM, a_r, value):
+                            continue
+                        if adaptive and point_done(process, mV, mDM, a_r, value):
+                            continue
+                        if packing:
+                            point = scan_point(mV, a_r, value)
+                            if not (process, point) in submitted_packed_points:
+                                packed_points.append((process, point))
+                            continue
+                        single_points.append((process, scan_point(mV, a_r, value), value))
+
+        # the longest jobs go first, with the queue or wall time chosen from their predicted runtime
+        model = runtime_model()
+        if local_run:
+            local_jobs.sort(key = lambda job: -predicted_runtime(model, job[0], job[1]))
+        for process, point, value in sorted(single_points, key = lambda job: -predicted_runtime(model, job[0], job[1])):
+            minutes = predicted_runtime(model, process, point)
+            if options.resubmit:
+                if resubmit_job(process, point['mV'], mDM, point['a_r'], value, minutes):
+                    job_counter += 1
+                    all_jobs_done = False
+                continue
+            if options.BR_run:
+                submit_job(process, '-a ' + str(point['a_r']) + ' -M ' + str(point['mV']) + ' -B ' + str(value), job_extra_options(), minutes)
+            else:
+                submit_job(process, '-a ' + str(point['a_r']) + ' -M ' + str(point['mV']) + ' -g ' + str(value), job_extra_options(), minutes)
+            job_counter += 1
+
+        if packing and not local_run:
+            if options.resubmit:
+                packed_points = missing_packed_points()
+            for points, estimated_minutes in pack_points(packed_points, int(options.points_per_job), float(options.pack_runtime), model):
+                submit_packed_job(points, job_extra_options(), estimated_minutes, options.resubmit)
+                job_counter += 1
+                all_jobs_done = False
+
+        if local_run and local_jobs:
+            failed_jobs = run_local_jobs(local_jobs, int(options.local_cores), int(options.cores_per_run), os.path.abspath(options.local_workspace))
+            print 'Number of failed local jobs: ' + str(failed_jobs)
+
+        # locally the refinement continues until the target resolution is reached,
+        # with batch jobs the script has to be rerun once the submitted jobs are done
+        if not (adaptive and local_run and local_jobs):
+            break
+
     if options.resubmit and all_jobs_done:
         print 'All jobs seem to have correct output, no jobs resubmitted.'
     else:
@@ -0,0 +1,111 @@
+# this script summarises the timing records (*.timing.json) written by calculate_MG_xsection.py
+# per process and mediator mass: runtime per point, share of each phase, CPU efficiency and peak memory,
+# and the width cross-checks (*.width_check.json) of the analytic widths mode (calculate_MG_xsection.py -W)
+
+import sys
+import json
+import numpy as np
+from os import listdir
+from os.path import isfile, join
+from optparse import OptionParser
+
+def read_timing_records(input_path, extension = '.timing.json'):
+    records = []
+    for f in sorted(listdir(input_path)):
+        filename = join(input_path, f)
+        if not isfile(filename) or not f.endswith(extension):
+            continue
+        input_file = open(filename, 'r')
+        try:
+            records.append(json.load(input_file))
+        except ValueError:
+            print 'Warning: could not read the timing record ', filename
+        input_file.close()
+    return records
+
+# group key of a record: the process, and the mediator mass if all points of the session share it
+def group_key(record, by_mass = True):
+    if not by_mass:
+        return (record['process'], '')
+    masses = set(record['mV'])
+    if len(masses) == 1:
+        return (record['process'], '%g' % masses.pop())
+    return (record['process'], 'mixed')
+
+def summarise(records, by_mass = True):
+    groups = {}
+    for record in records:
+        groups.setdefault(group_key(record, by_mass), []).append(record)
+
+    phases = []
+    for record in records:
+        for phase in record['phases']:
+            if not phase['phase'] in phases:
+                phases.append(phase['phase'])
+
+    print '%-14s %8s %6s %7s %12s %12s %12s %8s %10s %6s' % ('process', 'mV', 'jobs', 'points', 'min/point', 'median/job', 'max/job', 'CPU/wall', 'RSS [MB]', 'hosts')
+    for (process, mV), group in sorted(groups.items()):
+        wall_times = np.array([record['wall_time'] for record in group])
+        cpu_times = np.array([record['cpu_time'] for record in group])
+        number_of_points = sum(record['number_of_points'] for record in group)
+        peak_RSS = max(max(record['peak_RSS_MB'], record['peak_RSS_MG_MB']) for record in group)
+        hosts = set(record['host'] for record in group)
+        print '%-14s %8s %6d %7d %12.2f %12.2f %12.2f %8.2f %10.0f %6d' % (process, mV, len(group), number_of_points,
+                                                                            np.sum(wall_times)/60/number_of_points,
+                                                                            np.median(wall_times)/60, np.max(wall_times)/60,
+                                                                            np.sum(cpu_times)/np.sum(wall_times), peak_RSS, len(hosts))
+        total_wall_time = np.sum(wall_times)
+        shares = []
+        for phase in phases:
+            phase_time = sum(p['wall_time'] for record in group for p in record['phases'] if p['phase'] == phase)
+            if phase_time > 0:
+                shares.append('%s %.0f%%' % (phase, 100*phase_time/total_wall_time))
+        print '%-14s %8s   phases: %s' % ('', '', ', '.join(shares))
+
+def summarise_width_checks(records):
+    width_checks = {}
+    number_of_points = {}
+    for record in records:
+        width_checks.setdefault(record['process'], []).extend(record['width_checks'])
+        number_of_points[record['process']] = number_of_points.get(record['process'], 0) + record['number_of_points']
+
+    print '%-14s %8s %8s %10s %14s %14s' % ('process', 'points', 'checked', 'mismatch', 'max dG_tot/G', 'max dBR/BR')
+    mismatches = []
+    for process, checks in sorted(width_checks.items()):
+        process_mismatches = [check for check in checks if not check['match']]
+        mismatches += [(process, check) for check in process_mismatches]
+        if not checks:
+            print '%-14s %8d %8d' % (process, number_of_points[process], 0)
+            continue
+        print '%-14s %8d %8d %10d %14.2e %14.2e' % (process, number_of_points[process], len(checks), len(process_mismatches),
+                                                     max(check['relative_difference_G_tot'] for check in checks),
+                                                     max(check['relative_difference_BR'] for check in checks))
+    for process, check in mismatches:
+        print 'Mismatch %s %s: G_tot = %s (MG: %s), BR = %s (MG: %s)' % (process, check['point'], check['G_tot'], check['G_tot_MG'], check['BR'], check['BR_MG'])
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option( "-i", "--input_path", dest = "input_path", default = 'output_JSON/logs',
+                  help = "Set the path of the timing records (default: output_JSON/logs)" )
+    parser.add_option( "-p", "--per_process", action = "store_true", dest = "per_process",
+                  help = "Summarise per process only, not per mediator mass" )
+    parser.add_option( "-W", "--width_checks", action = "store_true", dest = "width_checks",
+                  help = "Summarise the width cross-checks of the analytic widths mode instead of the timing" )
+
+    ( options, args ) = parser.parse_args()
+
+    if options.width_checks:
+        records = read_timing_records(options.input_path, '.width_check.json')
+        if not records:
+            print 'No width cross-checks found in ', options.input_path
+            sys.exit(1)
+        summarise_width_checks(records)
+        sys.exit(0)
+
+    records = read_timing_records(options.input_path)
+    if not records:
+        print 'No timing records found in ', options.input_path
+        sys.exit(1)
+
+    print 'Read %s timing records from %s' % (len(records), options.input_path)
+    summarise(records, not options.per_process)